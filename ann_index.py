@@ -0,0 +1,178 @@
+import os
+import json
+import time
+import logging
+import argparse
+import numpy as np
+from similarity_store import STORE_DIRECTORY, SimilarityStore
+
+META_FILE = "ann_meta.json"
+
+
+class HNSWIndex:
+    """
+    HNSW graph index (hnswlib). `M` and `ef_construction` trade build time and
+    memory for recall; `ef_search` trades query latency for recall.
+    """
+    backend = "hnsw"
+
+    def __init__(self, M=32, ef_construction=200, ef_search=64):
+        try:
+            import hnswlib
+        except ImportError:
+            raise ImportError("The hnsw backend requires hnswlib: pip install hnswlib")
+        self._hnswlib = hnswlib
+        self.params = {"M": M, "ef_construction": ef_construction, "ef_search": ef_search}
+        self.index = None
+
+    def build(self, embeddings, block_size=65536):
+        self.index = self._hnswlib.Index(space="ip", dim=embeddings.shape[1])
+        self.index.init_index(max_elements=len(embeddings), ef_construction=self.params["ef_construction"],
+                              M=self.params["M"])
+        for start in range(0, len(embeddings), block_size):
+            block = np.asarray(embeddings[start:start + block_size], dtype=np.float32)
+            self.index.add_items(block, np.arange(start, start + len(block)))
+        self.index.set_ef(self.params["ef_search"])
+
+    def search(self, queries, k):
+        self.index.set_ef(max(self.params["ef_search"], k))
+        rows, distances = self.index.knn_query(np.asarray(queries, dtype=np.float32), k=k)
+        return 1 - distances, rows.astype(np.int64)
+
+    def save(self, path):
+        self.index.save_index(path)
+
+    def load(self, path, dim, size):
+        self.index = self._hnswlib.Index(space="ip", dim=dim)
+        self.index.load_index(path, max_elements=size)
+        self.index.set_ef(self.params["ef_search"])
+
+
+class IVFPQIndex:
+    """
+    Inverted-file index with product quantization (faiss). `nlist` and `m`
+    (sub-quantizers) set the memory/accuracy trade-off at build time; `nprobe`
+    trades query latency for recall.
+    """
+    backend = "ivfpq"
+
+    def __init__(self, nlist=1024, m=16, nbits=8, nprobe=16, train_size=100000):
+        try:
+            import faiss
+        except ImportError:
+            raise ImportError("The ivfpq backend requires faiss: pip install faiss-cpu")
+        self._faiss = faiss
+        self.params = {"nlist": nlist, "m": m, "nbits": nbits, "nprobe": nprobe, "train_size": train_size}
+        self.index = None
+
+    def build(self, embeddings, block_size=65536):
+        faiss = self._faiss
+        dim = embeddings.shape[1]
+        nlist = min(self.params["nlist"], len(embeddings))
+        quantizer = faiss.IndexFlatIP(dim)
+        self.index = faiss.IndexIVFPQ(quantizer, dim, nlist, self.params["m"], self.params["nbits"],
+                                      faiss.METRIC_INNER_PRODUCT)
+        sample = np.random.default_rng(0).choice(len(embeddings), min(self.params["train_size"], len(embeddings)),
+                                                 replace=False)
+        self.index.train(np.asarray(embeddings[np.sort(sample)], dtype=np.float32))
+        for start in range(0, len(embeddings), block_size):
+            self.index.add(np.asarray(embeddings[start:start + block_size], dtype=np.float32))
+        self.index.nprobe = self.params["nprobe"]
+
+    def search(self, queries, k):
+        self.index.nprobe = self.params["nprobe"]
+        scores, rows = self.index.search(np.asarray(queries, dtype=np.float32), k)
+        return scores, rows.astype(np.int64)
+
+    def save(self, path):
+        self._faiss.write_index(self.index, path)
+
+    def load(self, path, dim, size):
+        self.index = self._faiss.read_index(path)
+        self.index.nprobe = self.params["nprobe"]
+
+
+ANN_BACKENDS = {"hnsw": HNSWIndex, "ivfpq": IVFPQIndex}
+
+
+def build_ann_index(directory=STORE_DIRECTORY, backend="hnsw", **params):
+    """
+    Builds an ANN index over the store's embeddings and saves it (with its
+    parameters) next to them, so SimilarityStore picks it up when loaded.
+    """
+    store = SimilarityStore(directory, use_ann=False)
+    index = ANN_BACKENDS[backend](**params)
+    index.build(store.embeddings)
+    index.save(os.path.join(directory, f"ann.{backend}"))
+    with open(os.path.join(directory, META_FILE), "w", encoding="utf-8") as f:
+        json.dump({"backend": backend, "params": index.params, "size": len(store.embeddings),
+                   "manifest_hash": store.manifest_hash}, f)
+    return index
+
+
+def load_ann_index(directory, dim, size, manifest_hash, **overrides):
+    """
+    Loads the ANN index saved in the store directory, or returns None if there
+    is none or it was built from other rows than the store's manifest lists
+    (see similarity_store.manifest_hash). Search-time parameters (ef_search,
+    nprobe) can be overridden.
+    """
+    meta_path = os.path.join(directory, META_FILE)
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path, "r", encoding="utf-8") as f:
+        meta = json.load(f)
+    if meta["size"] != size or meta.get("manifest_hash") != manifest_hash:
+        logging.warning(f"Ignoring stale {meta['backend']} index ({meta['size']} rows, store has {size}); "
+                        f"run `python ann_index.py build` again")
+        return None
+    params = dict(meta["params"], **overrides)
+    index = ANN_BACKENDS[meta["backend"]](**params)
+    index.load(os.path.join(directory, f"ann.{meta['backend']}"), dim, meta["size"])
+    return index
+
+
+def benchmark(directory=STORE_DIRECTORY, k=10, num_queries=200, rescore_factors=(0, 4), **search_params):
+    """
+    Measures recall@k and per-query latency of the store's ANN index against
+    brute-force search, using corpus rows as queries. A rescore factor of 0
+    means the ANN scores are used without exact rescoring.
+    """
+    store = SimilarityStore(directory, ann_params=search_params)
+    if store.ann is None:
+        raise ValueError(f"No ANN index in {directory}; run `python ann_index.py build` first")
+    live_rows = np.flatnonzero(store.alive)
+    rows = np.random.default_rng(0).choice(live_rows, min(num_queries, len(live_rows)), replace=False)
+    queries = np.asarray(store.embeddings[np.sort(rows)], dtype=np.float32)
+
+    start = time.perf_counter()
+    exact = [set(store.top_k(query, k=k, exact=True)[1].tolist()) for query in queries]
+    results = {"exact": {"latency_ms": 1000 * (time.perf_counter() - start) / len(queries), "recall": 1.0}}
+
+    for factor in rescore_factors:
+        start = time.perf_counter()
+        found = [set(store.top_k(query, k=k, rescore_factor=factor)[1].tolist()) for query in queries]
+        latency = 1000 * (time.perf_counter() - start) / len(queries)
+        recall = np.mean([len(f & e) / len(e) for f, e in zip(found, exact)])
+        results[f"{store.ann.backend}_rescore_x{factor}"] = {"latency_ms": latency, "recall": float(recall)}
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build or benchmark the ANN index for judgment similarity.")
+    parser.add_argument("command", choices=["build", "benchmark"])
+    parser.add_argument("--store", default=STORE_DIRECTORY)
+    parser.add_argument("--backend", choices=sorted(ANN_BACKENDS), default="hnsw")
+    parser.add_argument("--param", action="append", default=[], metavar="NAME=VALUE",
+                        help="backend parameter, e.g. M=32, ef_search=128, nlist=4096, nprobe=32")
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--queries", type=int, default=200)
+    args = parser.parse_args()
+
+    params = {name: int(value) for name, value in (param.split("=", 1) for param in args.param)}
+    if args.command == "build":
+        start = time.perf_counter()
+        build_ann_index(args.store, args.backend, **params)
+        print(f"Built {args.backend} index in {time.perf_counter() - start:.1f}s")
+    else:
+        print(json.dumps(benchmark(args.store, k=args.k, num_queries=args.queries, **params), indent=2))
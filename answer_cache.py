@@ -0,0 +1,118 @@
+import os
+import re
+import json
+import time
+import threading
+from collections import OrderedDict
+
+
+def normalize_question(question):
+    """
+    Lower-cases the question, collapses whitespace and drops trailing
+    punctuation so trivially different phrasings share a cache entry.
+    """
+    question = re.sub(r"\s+", " ", question.strip().lower())
+    return question.rstrip(" ?.!")
+
+
+class AnswerCache:
+    """
+    LRU cache of QA answers keyed by (corpus version, normalized question).
+    Entries expire after `ttl` seconds. When `persist_path` is set the cache
+    is loaded from that file and put() appends the new entry to it as one
+    JSON line, outside the lock lookups take. The file is rewritten from
+    memory once it holds twice `max_entries` lines.
+    """
+
+    def __init__(self, max_entries=1024, ttl=3600, persist_path=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.persist_path = persist_path
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        # Serialises appends and compaction of the persisted log.
+        self._log_lock = threading.Lock()
+        self._log_lines = 0
+        if persist_path and os.path.exists(persist_path):
+            self._load()
+
+    def get(self, corpus_version, question):
+        key = (corpus_version, normalize_question(question))
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or self._expired(entry):
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry["doc_texts"], entry["answer"]
+
+    def put(self, corpus_version, question, doc_texts, answer):
+        key = (corpus_version, normalize_question(question))
+        entry = {"doc_texts": doc_texts, "answer": answer, "created": time.time()}
+        with self._lock:
+            self._insert([(key, entry)])
+        if self.persist_path:
+            self._append(key, entry)
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses,
+                    "hit_rate": self.hits / total if total else 0.0}
+
+    def _expired(self, entry, now=None):
+        return bool(self.ttl) and (now or time.time()) - entry["created"] > self.ttl
+
+    def _insert(self, items):
+        for key, entry in items:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _load(self):
+        rewrite = False
+        now = time.time()
+        with open(self.persist_path, "r", encoding="utf-8") as f:
+            for line in f:
+                # A line without a newline was cut short by a crash mid-append,
+                # or is a cache saved before the log format (one JSON list of entries).
+                rewrite = rewrite or not line.endswith("\n")
+                try:
+                    items = json.loads(line)
+                except ValueError:
+                    continue
+                if len(items) == 2 and isinstance(items[1], dict):
+                    items = [items]
+                self._insert((tuple(key), entry) for key, entry in items if not self._expired(entry, now))
+                self._log_lines += 1
+        if rewrite or self._log_lines > 2 * self.max_entries:
+            # Later appends must start on a line of their own.
+            with self._log_lock:
+                self._compact()
+
+    def _append(self, key, entry):
+        line = json.dumps([list(key), entry]) + "\n"
+        with self._log_lock:
+            os.makedirs(os.path.dirname(self.persist_path) or ".", exist_ok=True)
+            with open(self.persist_path, "a", encoding="utf-8") as f:
+                f.write(line)
+            self._log_lines += 1
+            if self._log_lines > 2 * self.max_entries:
+                self._compact()
+
+    def _compact(self):
+        # Drops evicted, overwritten and expired entries from the log; called with _log_lock held.
+        now = time.time()
+        with self._lock:
+            items = [(key, entry) for key, entry in self._entries.items() if not self._expired(entry, now)]
+        tmp_path = self.persist_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.writelines(json.dumps([list(key), entry]) + "\n" for key, entry in items)
+        os.replace(tmp_path, self.persist_path)
+        self._log_lines = len(items)
@@ -75,10 +75,12 @@
 #     return render_template('base.html', error="Internal server error"), 500
 
 import os
+import json
 import logging
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, render_template, request, jsonify, Response, stream_with_context
 from werkzeug.utils import secure_filename
-from utils import process_text, allowed_file
+from utils import process_text, allowed_file, read_uploaded_documents
+from model_registry import registry
 import shutil
 
 logging.basicConfig(level=logging.DEBUG)
@@ -92,6 +94,12 @@ app.config['UPLOAD_FOLDER'] = os.path.join(os.getcwd(), "tmp")
 if not os.path.exists(app.config['UPLOAD_FOLDER']):
     os.makedirs(app.config['UPLOAD_FOLDER'])
 
+# Optionally load models at startup instead of on first request,
+# e.g. CASESAGE_PRELOAD_MODELS="ner,summarization,similarity_encoder".
+if os.environ.get("CASESAGE_PRELOAD_MODELS"):
+    import semantic_module, similarity_module  # register their models
+    registry.preload([name.strip() for name in os.environ["CASESAGE_PRELOAD_MODELS"].split(",") if name.strip()])
+
 @app.route('/')
 def home():
     return render_template('home.html')
@@ -148,6 +156,95 @@ def process():
         logging.error(f"Error processing request: {str(e)}")
         return jsonify({'error': 'An error occurred during processing'}), 500
 
+@app.route('/process/stream', methods=['POST'])
+def process_stream():
+    # Server-sent events for qa_query: retrieved sources first, then answer tokens.
+    question = request.form.get('question', '')
+    if not question:
+        return jsonify({'error': 'Please input a valid question.'}), 400
+
+    def events():
+        from qa_module import qa_stream_answer
+        try:
+            for event, data in qa_stream_answer(question):
+                yield f"event: {event}\ndata: {json.dumps(data)}\n\n"
+            yield "event: done\ndata: {}\n\n"
+        except Exception as e:
+            logging.error(f"Error streaming answer: {str(e)}")
+            yield f"event: error\ndata: {json.dumps('An error occurred during processing')}\n\n"
+
+    return Response(stream_with_context(events()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/similarity/batch', methods=['POST'])
+def similarity_batch():
+    # Accepts JSON {"documents": [{"id": ..., "text": ...}], "k": 5} or multipart "files" uploads.
+    try:
+        from similarity_module import batch_similarity
+        payload = request.get_json(silent=True)
+        if payload is not None:
+            documents = [(doc.get('id', i), doc.get('text', '')) for i, doc in enumerate(payload.get('documents', []))]
+            k = int(payload.get('k', 5))
+        else:
+            try:
+                documents = read_uploaded_documents(request.files.getlist('files'))
+            except ValueError as e:
+                return jsonify({'error': str(e)}), 400
+            k = int(request.form.get('k', 5))
+        if not documents:
+            return jsonify({'error': 'No documents provided'}), 400
+        return jsonify({'results': batch_similarity(documents, k=k)})
+    except Exception as e:
+        logging.error(f"Error processing batch similarity: {str(e)}")
+        return jsonify({'error': 'An error occurred during processing'}), 500
+
+@app.route('/semantic/batch', methods=['POST'])
+def semantic_batch():
+    # Accepts JSON {"documents": [{"id": ..., "text": ...}], "format": "json"} or multipart "files" uploads.
+    # format "html" adds each document's highlighted rendering.
+    try:
+        from semantic_module import label_documents, render_html
+        payload = request.get_json(silent=True)
+        if payload is not None:
+            documents = [(doc.get('id', i), doc.get('text', '')) for i, doc in enumerate(payload.get('documents', []))]
+            output_format = payload.get('format', 'json')
+        else:
+            try:
+                documents = read_uploaded_documents(request.files.getlist('files'))
+            except ValueError as e:
+                return jsonify({'error': str(e)}), 400
+            output_format = request.form.get('format', 'json')
+        if not documents:
+            return jsonify({'error': 'No documents provided'}), 400
+        result = label_documents(documents)
+        if output_format == 'html':
+            for document in result['documents']:
+                document['html'] = render_html(document)
+        return jsonify(result)
+    except Exception as e:
+        logging.error(f"Error processing batch labelling: {str(e)}")
+        return jsonify({'error': 'An error occurred during processing'}), 500
+
+@app.route('/qa/cache/stats')
+def answer_cache_stats():
+    from qa_module import answer_cache
+    return jsonify(answer_cache.stats())
+
+@app.route('/semantic/cache/stats')
+def label_cache_stats():
+    from semantic_module import label_cache
+    return jsonify(label_cache.stats())
+
+@app.route('/summary/cache/stats')
+def summary_cache_stats():
+    from summarization_module import summary_cache
+    return jsonify(summary_cache.stats())
+
+@app.route('/models/stats')
+def model_stats():
+    return jsonify({'models': registry.stats(), 'resident_bytes': registry.resident_bytes(),
+                    'memory_budget': registry.memory_budget})
+
 @app.errorhandler(404)
 def not_found_error(error):
     return render_template('base.html', error="Page not found"), 404
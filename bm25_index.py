@@ -0,0 +1,85 @@
+import os
+import hashlib
+import pickle
+import threading
+
+
+def default_preprocess(text):
+    # Same tokenisation as langchain's BM25Retriever.
+    return text.split()
+
+
+class BM25Index:
+    """
+    On-disk manifest of the files indexed for QA retrieval.
+
+    Records every ingested file with a fingerprint of it, so unchanged files
+    are never re-indexed and the corpus version changes whenever a file is
+    added, replaced or removed. The BM25 postings and chunk vectors live in
+    HybridIndex, saved next to this manifest.
+    """
+
+    def __init__(self, index_path):
+        self.index_path = index_path
+        self.files = {}
+        self._version = None
+        self._lock = threading.RLock()
+
+    @classmethod
+    def load(cls, index_path):
+        index = cls(index_path)
+        if os.path.exists(index_path):
+            with open(index_path, "rb") as f:
+                state = pickle.load(f)
+            index.files = {file_path: {"fingerprint": entry["fingerprint"], "doc_hash": entry.get("doc_hash")}
+                           for file_path, entry in state["files"].items()}
+        return index
+
+    def save(self):
+        with self._lock:
+            state = {"files": self.files}
+            os.makedirs(os.path.dirname(self.index_path) or ".", exist_ok=True)
+            tmp_path = self.index_path + ".tmp"
+            with open(tmp_path, "wb") as f:
+                pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, self.index_path)
+
+    def version(self):
+        """
+        Short hash of the indexed files and their fingerprints; changes
+        whenever a file is added, replaced or removed.
+        """
+        with self._lock:
+            if self._version is None:
+                sha = hashlib.sha256()
+                for file_path in sorted(self.files):
+                    sha.update(f"{file_path}:{self.files[file_path]['fingerprint']}\n".encode("utf-8"))
+                self._version = sha.hexdigest()[:16]
+            return self._version
+
+    def has_file(self, file_path, fingerprint):
+        entry = self.files.get(file_path)
+        return entry is not None and entry["fingerprint"] == fingerprint
+
+    def add_file(self, file_path, fingerprint, doc_hash=None):
+        with self._lock:
+            self.files[file_path] = {"fingerprint": fingerprint, "doc_hash": doc_hash}
+            self._version = None
+
+    def find_content(self, doc_hash, exclude=None):
+        """
+        Returns an indexed file other than `exclude` whose content hash is
+        doc_hash, or None.
+        """
+        if doc_hash is None:
+            return None
+        with self._lock:
+            for file_path, entry in self.files.items():
+                if file_path != exclude and entry.get("doc_hash") == doc_hash:
+                    return file_path
+        return None
+
+    def remove_file(self, file_path):
+        with self._lock:
+            if self.files.pop(file_path, None) is not None:
+                self._version = None
@@ -0,0 +1,160 @@
+import os
+import glob
+import time
+import json
+import shutil
+import tempfile
+import argparse
+import numpy as np
+
+POOLING_STRATEGIES = ("truncate", "mean", "max", "maxsim")
+
+
+def split_windows(tokenizer, text, window_tokens, overlap_tokens=64):
+    """
+    Splits text into overlapping windows of at most `window_tokens` tokens.
+    The text is tokenized once and windows are cut on the tokenizer's
+    character offsets, so each window re-tokenizes to (about) the same tokens.
+    """
+    encoding = tokenizer(text, add_special_tokens=False, return_offsets_mapping=True, verbose=False)
+    offsets = encoding["offset_mapping"]
+    if len(offsets) <= window_tokens:
+        return [text]
+    step = max(window_tokens - overlap_tokens, 1)
+    windows = []
+    for start in range(0, len(offsets), step):
+        end = min(start + window_tokens, len(offsets))
+        windows.append(text[offsets[start][0]:offsets[end - 1][1]])
+        if end == len(offsets):
+            break
+    return windows
+
+
+def pool(window_vectors, strategy):
+    """
+    Pools a (windows, dim) matrix into one normalised document vector.
+    "maxsim" keeps no single vector, so its first-stage vector is the mean.
+    """
+    if strategy == "max":
+        vector = window_vectors.max(axis=0)
+    else:
+        vector = window_vectors.mean(axis=0)
+    return vector / max(float(np.linalg.norm(vector)), 1e-12)
+
+
+class ChunkedEncoder:
+    """
+    Encodes long judgments with a SentenceTransformer by splitting them into
+    windows of the model's max sequence length. The windows of all texts in a
+    call are encoded together in batched forward passes.
+    """
+
+    def __init__(self, model, pooling="mean", overlap_tokens=64):
+        self.model = model
+        self.pooling = pooling
+        self.overlap_tokens = overlap_tokens
+        # Leave room for the [CLS]/[SEP] (or <s>/</s>) tokens added by the model.
+        self.window_tokens = model.max_seq_length - 2
+
+    def encode_windows(self, texts, batch_size=32):
+        """
+        Returns one normalised (windows, dim) matrix per text.
+        """
+        windows, counts = [], []
+        for text in texts:
+            text_windows = split_windows(self.model.tokenizer, text, self.window_tokens, self.overlap_tokens)
+            windows.extend(text_windows)
+            counts.append(len(text_windows))
+        vectors = self.model.encode(windows, batch_size=batch_size, convert_to_numpy=True,
+                                    normalize_embeddings=True)
+        return np.split(vectors, np.cumsum(counts)[:-1])
+
+    def encode(self, texts, batch_size=32, convert_to_numpy=True, normalize_embeddings=True):
+        if self.pooling == "truncate":
+            return self.model.encode(texts, batch_size=batch_size, convert_to_numpy=True,
+                                     normalize_embeddings=True)
+        return np.stack([pool(vectors, self.pooling) for vectors in self.encode_windows(texts, batch_size)])
+
+
+def search(store, encoder, query_text, k=5):
+    """
+    Encodes a query judgment the way the store's corpus was encoded and
+    returns (scores, rows) of the top k documents.
+    """
+    if store.pooling == "truncate":
+        return store.top_k(encoder.model.encode(query_text, convert_to_numpy=True), k=k)
+    windows = encoder.encode_windows([query_text])[0]
+    if store.pooling == "maxsim":
+        return store.top_k_maxsim(windows, k=k)
+    return store.top_k(pool(windows, store.pooling), k=k)
+
+
+def search_batch(store, encoder, query_texts, k=5, batch_size=32):
+    """
+    Batch version of search(): encodes all query texts in batched forward
+    passes and scores them against the corpus together. Returns a list of
+    (scores, rows) per query.
+    """
+    if store.pooling == "maxsim":
+        return [store.top_k_maxsim(windows, k=k) for windows in encoder.encode_windows(query_texts, batch_size)]
+    scores, rows = store.top_k_batch(encoder.encode(query_texts, batch_size=batch_size), k=k)
+    return list(zip(scores, rows))
+
+
+def benchmark(model, dataset_path="data", strategies=POOLING_STRATEGIES, k=5, max_docs=200):
+    """
+    Builds a temporary store per pooling strategy and uses the second half of
+    each document as a query. Reports recall@1 and recall@k of the source
+    document, and mean build and query latency.
+    """
+    from similarity_store import SimilarityStore, create_empty_store, update_store
+    files = sorted(glob.glob(os.path.join(dataset_path, "*.txt")))[:max_docs]
+    queries = []
+    for file in files:
+        with open(file, "r") as f:
+            text = f.read()
+        queries.append((os.path.basename(file), text[len(text) // 2:]))
+
+    results = {}
+    workdir = tempfile.mkdtemp()
+    try:
+        data_dir = os.path.join(workdir, "data")
+        os.makedirs(data_dir)
+        for file in files:
+            shutil.copy(file, data_dir)
+        for strategy in strategies:
+            directory = os.path.join(workdir, strategy)
+            encoder = ChunkedEncoder(model, pooling=strategy)
+            start = time.perf_counter()
+            create_empty_store(directory, model.get_sentence_embedding_dimension(), strategy)
+            update_store(encoder, data_dir, directory)
+            build_seconds = time.perf_counter() - start
+
+            store = SimilarityStore(directory, use_ann=False)
+            hits_at_1 = hits_at_k = 0
+            start = time.perf_counter()
+            for name, query_text in queries:
+                _, rows = search(store, encoder, query_text, k=k)
+                found = [store.names[row] for row in rows]
+                hits_at_1 += found[:1] == [name]
+                hits_at_k += name in found
+            query_ms = 1000 * (time.perf_counter() - start) / max(len(queries), 1)
+            results[strategy] = {"recall@1": hits_at_1 / max(len(queries), 1),
+                                 f"recall@{k}": hits_at_k / max(len(queries), 1),
+                                 "query_latency_ms": query_ms, "build_seconds": build_seconds}
+    finally:
+        shutil.rmtree(workdir)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark pooling strategies for long-judgment similarity.")
+    parser.add_argument("--data", default="data")
+    parser.add_argument("--model", default="fine_tuned_similarity_model_ver2.0")
+    parser.add_argument("--strategies", default=",".join(POOLING_STRATEGIES))
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--max-docs", type=int, default=200)
+    args = parser.parse_args()
+    from sentence_transformers import SentenceTransformer
+    print(json.dumps(benchmark(SentenceTransformer(args.model), args.data, args.strategies.split(","),
+                               k=args.k, max_docs=args.max_docs), indent=2))
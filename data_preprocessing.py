@@ -1,62 +1,75 @@
-import pandas as pd
 import re
-from tqdm import tqdm
+import bisect
+
+
+WORD_PATTERN = re.compile(r'\b\S+\b')
+
+
+class WordIndex:
+    """
+      Word positions of a document, computed once.
+
+      Params:
+        - text: document text
+
+      Attributes:
+        - words: the document's words, as re.findall(r'\b\S+\b', text) returns them
+        - starts: character offset of every word, for bisection
+    """
+
+    def __init__(self, text: str):
+        self.text = text
+        self.words = []
+        self.starts = []
+        for match in WORD_PATTERN.finditer(text):
+            self.words.append(match.group())
+            self.starts.append(match.start())
 
 
 def index_in_words(text: str,
-                   char_index: int) -> int:
+                   char_index: int,
+                   index: WordIndex = None) -> int:
     """
       Converts the given char_index its equivalent word_index in the given text.
 
       Params:
         - text: text useful to convert the char_index
         - char_index: char position in the given text
+        - index: WordIndex of the text, to look the position up by bisection
 
       Returns:
         - word_index: equivalent word position the given text
     """
 
-    # Find the previous and next spaces around the index
-    prev_space = text[:char_index].rfind(' ')
-    next_space = text[char_index:].find(' ')
-
     if char_index == 0:
         return 0
 
-    # If both are found
-    if prev_space != -1 and next_space != -1:
-
-        # Count the number of words before the current word
-        word_index = len(re.findall(r'\b\S+\b', text[:prev_space]))
-        return word_index
-
-    # If only the previous space is found
-    elif prev_space != -1:
-
-        # Count the number of words before the current word
-        word_index = len(re.findall(r'\b\S+\b', text[:prev_space]))
-        return word_index
+    # Find the previous and next spaces around the index
+    prev_space = text.rfind(' ', 0, char_index)
 
-    # If only the next space is found
-    elif next_space != -1:
+    # If a previous space is found, count the number of words before it. No
+    # word spans a space, so these are the words starting before prev_space.
+    if prev_space != -1:
+        if index is None:
+            index = WordIndex(text)
+        return bisect.bisect_left(index.starts, prev_space)
 
-        # Count the number of words before the next word
-        word_index = len(re.findall(r'\b\S+\b', text[:char_index]))
-        return word_index - 1
+    next_space = text.find(' ', char_index)
 
-    # If no space is found
-    else:
+    # If only the next space is found, count the number of words before the next word
+    if next_space != -1:
+        return len(WORD_PATTERN.findall(text[:char_index])) - 1
 
-        # Count the number of words before the next word
-        word_index = len(re.findall(r'\b\S+\b', text[:char_index]))
-        return word_index
+    # If no space is found, count the number of words before the next word
+    return len(WORD_PATTERN.findall(text[:char_index]))
 
 
 def get_context(text: str,
                 sentence: str,
                 span_start: int,
                 span_end: int,
-                max_len: int) -> str:
+                max_len: int,
+                index: WordIndex = None) -> str:
     """
       Given the sentence, it extracts the context of the sentence
       from the text, that fits the transformer
@@ -66,136 +79,53 @@ def get_context(text: str,
         sentence: sentence
         span_start: start position of the sentence at char-level
         span_end: end position of the sentence at char-level
+        index: WordIndex of the text; build it once per document when
+          extracting the context of many sentences
 
       Returns:
         context: context string, including the sentence
     """
 
-    context = []
+    if index is None:
+        index = WordIndex(text)
+    words = index.words
 
     # Positions at word-level
-    span_start = index_in_words(text, span_start)
-    span_end = index_in_words(text, span_end)
+    span_start = index_in_words(text, span_start, index)
+    span_end = index_in_words(text, span_end, index)
 
-    # Divide the given string into words, deleting space characters
-    text = re.findall(r'\b\S+\b', text)
-    sentence = re.findall(r'\b\S+\b', sentence)
+    sentence = WORD_PATTERN.findall(sentence)
     len_sentence = len(sentence)
 
     # Empty context
     if len_sentence > max_len:
-        return " ".join(context)
+        return ""
 
     # Get length of the window
     len_window = int((max_len - (len_sentence * 2)) / 2)
 
     if len_window <= 0:
-        return " ".join(context)
+        return ""
 
     # First sentence
     if span_start <= 0:
-        context += sentence
-
-        idx = span_end + 1
-        while idx <= span_end + len_window * 2:
-            context.append(text[idx])
-            idx += 1
-
-        return " ".join(context)
+        context = sentence + words[span_end + 1:span_end + len_window * 2 + 1]
 
     # Last sentence
-    if span_end >= len(text):
-        idx = span_start - len_window * 2
-        while idx < span_start:
-            context.append(text[idx])
-            idx += 1
-
-        context += sentence
-
-        return " ".join(context)
+    elif span_end >= len(words):
+        context = words[max(span_start - len_window * 2, 0):span_start] + sentence
 
     # Left context smaller than window
-    if span_start < len_window:
-        idx = 0
-        while idx < span_start:
-            context.append(text[idx])
-            idx += 1
-
-        context += sentence
-
-        idx = span_end + 1
-        while idx <= span_end + len_window + (len_window - span_start):
-            context.append(text[idx])
-            idx += 1
-
-        return " ".join(context)
+    elif span_start < len_window:
+        context = words[:span_start] + sentence + words[span_end + 1:span_end + len_window * 2 - span_start + 1]
 
     # Right context smaller than window
-    if len_window > (len(text) - span_end):
-        idx = span_start - len_window - (len_window - (len(text) - span_end))
-        while idx < span_start:
-            context.append(text[idx])
-            idx += 1
+    elif len_window > (len(words) - span_end):
+        left = span_start - len_window - (len_window - (len(words) - span_end))
+        context = words[max(left, 0):span_start] + sentence + words[span_end + 1:]
 
-        context += sentence
-
-        idx = span_end + 1
-        while idx <= len(text) - 1:
-            context.append(text[idx])
-            idx += 1
-
-        return " ".join(context)
-
-    # Append left context
-    idx = span_start - len_window
-    while idx < span_start:
-        context.append(text[idx])
-        idx += 1
-
-    context += sentence
-
-    # Append right context
-    idx = span_end + 1
-    while idx < span_end + len_window:
-        context.append(text[idx])
-        idx += 1
+    # Left and right context
+    else:
+        context = words[span_start - len_window:span_start] + sentence + words[span_end + 1:span_end + len_window]
 
     return " ".join(context)
-
-
-def rearrange_df(data: list,
-                 max_len_context: int) -> pd.DataFrame:
-    """
-      Given the dataset, extract useful columns from the dataset and converts it into a Pandas DataFrame
-
-      Params:
-        data: dataset
-
-      Returns:
-        new_dataset: DataFrame with the useful columns extracted from the given dataset
-    """
-
-    cols = ['doc_id', 'text', 'context', 'sentence', 'label']
-
-    dataset = []
-
-    for doc in tqdm(data):
-        for doc_ann in doc['annotations']:
-            for sent in doc_ann['result']:
-                sentence = sent['value']['text']
-
-                sentence_start = sent['value']['start']
-                sentence_end = sent['value']['end']
-
-                temp_list = [doc['id'], doc['data']['text'],
-                             get_context(doc['data']['text'], sentence, sentence_start, sentence_end, max_len_context),
-                             sentence, sent['value']['labels'][0]]
-
-                dataset.append(temp_list)
-
-    new_dataset = pd.DataFrame(dataset, columns=cols)
-
-    # Drop duplicates
-    new_dataset.drop_duplicates(['text', 'sentence'], inplace = True)
-
-    return new_dataset
@@ -0,0 +1,301 @@
+import os
+import pickle
+import threading
+from collections import Counter, defaultdict
+from typing import List, Optional
+import numpy as np
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.retrievers import BaseRetriever
+from bm25_index import default_preprocess
+from quantization import QuantizedVectors
+
+
+class HybridIndex:
+    """
+    Sparse (BM25) and dense (cosine) scoring over the same set of chunk IDs.
+
+    Chunks are appended incrementally; on the first search after a change the
+    postings and vectors are frozen into flat numpy arrays (a CSC-style
+    term -> rows layout for BM25 weights and one row-normalised matrix for the
+    embeddings), so both signals are scored for a whole batch of queries with
+    array operations and fused with weighted reciprocal rank fusion.
+
+    save() writes the frozen arrays to one file that load() reads back without
+    re-tokenising or re-fetching any chunk.
+    """
+
+    def __init__(self, k1=1.5, b=0.75, dense_quantization=None, vector_source=None, rescore_factor=4):
+        self.k1 = k1
+        self.b = b
+        # With dense_quantization ("int8" or "binary") only a compressed copy of
+        # the vectors is kept in memory; the dense top candidates are rescored
+        # with float vectors fetched through vector_source(ids).
+        self.dense_quantization = dense_quantization
+        self.vector_source = vector_source
+        self.rescore_factor = rescore_factor
+        self.ids = []
+        self.texts = []
+        self.metadatas = []
+        self._rows = {}
+        self._alive = []
+        self._lengths = []
+        self._vectors = []
+        # Postings as CSC arrays (term -> rows); terms of chunks added since the
+        # last _freeze() wait in _term_rows / _term_tfs until they are merged.
+        self._vocab = {}
+        self._indptr = np.zeros(1, dtype=np.int64)
+        self._posting_rows = np.zeros(0, dtype=np.int64)
+        self._posting_tfs = np.zeros(0, dtype=np.float32)
+        self._term_rows = defaultdict(list)
+        self._term_tfs = defaultdict(list)
+        self._frozen = None
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __contains__(self, id_):
+        return id_ in self._rows
+
+    def save(self, path):
+        with self._lock:
+            frozen = self._freeze()
+            state = {"ids": self.ids, "texts": self.texts, "metadatas": self.metadatas,
+                     "alive": frozen["alive"], "lengths": np.array(self._lengths, dtype=np.int32),
+                     "terms": list(self._vocab), "indptr": self._indptr, "posting_rows": self._posting_rows,
+                     "posting_tfs": self._posting_tfs, "dense_quantization": self.dense_quantization,
+                     "vectors": frozen["dense"]}
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, "wb") as f:
+                pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path, **kwargs):
+        """
+        Returns the index saved at `path`, or None when there is none or it
+        holds quantized vectors of another kind than requested.
+        """
+        if not os.path.exists(path):
+            return None
+        with open(path, "rb") as f:
+            state = pickle.load(f)
+        index = cls(**kwargs)
+        vectors = state["vectors"]
+        if state["dense_quantization"] != index.dense_quantization:
+            if state["dense_quantization"]:
+                return None
+            if vectors is not None:
+                vectors = QuantizedVectors.from_matrix(index.dense_quantization, vectors)
+        index.ids, index.texts, index.metadatas = state["ids"], state["texts"], state["metadatas"]
+        index._alive = state["alive"].tolist()
+        index._rows = {id_: row for row, (id_, alive) in enumerate(zip(index.ids, index._alive)) if alive}
+        index._lengths = state["lengths"].tolist()
+        index._vectors = [vectors] if vectors is not None else []
+        index._vocab = {term: col for col, term in enumerate(state["terms"])}
+        index._indptr, index._posting_rows, index._posting_tfs = (
+            state["indptr"], state["posting_rows"], state["posting_tfs"])
+        return index
+
+    def add(self, ids, texts, metadatas, vectors):
+        with self._lock:
+            vectors = np.asarray(vectors, dtype=np.float32).reshape(len(ids), -1)
+            keep = []
+            for position, (id_, text, metadata) in enumerate(zip(ids, texts, metadatas)):
+                if id_ in self._rows:
+                    continue
+                row = len(self.ids)
+                self._rows[id_] = row
+                self.ids.append(id_)
+                self.texts.append(text)
+                self.metadatas.append(dict(metadata or {}))
+                self._alive.append(True)
+                tokens = default_preprocess(text)
+                self._lengths.append(len(tokens))
+                for term, tf in Counter(tokens).items():
+                    self._term_rows[term].append(row)
+                    self._term_tfs[term].append(tf)
+                keep.append(position)
+            if keep:
+                norms = np.linalg.norm(vectors[keep], axis=1, keepdims=True)
+                normalized = vectors[keep] / np.maximum(norms, 1e-12)
+                if self.dense_quantization:
+                    normalized = QuantizedVectors.from_matrix(self.dense_quantization, normalized)
+                self._vectors.append(normalized)
+                self._frozen = None
+
+    def remove(self, ids):
+        with self._lock:
+            for id_ in ids:
+                row = self._rows.pop(id_, None)
+                if row is not None:
+                    self._alive[row] = False
+                    self._frozen = None
+
+    def _merge_postings(self):
+        # Appends the pending postings to the CSC arrays. The vocabulary is
+        # copied, so a frozen snapshot in use by a search is never changed.
+        if not self._term_rows:
+            return
+        vocab = dict(self._vocab)
+        new_terms, new_rows, new_tfs = [], [], []
+        for term, term_rows in self._term_rows.items():
+            col = vocab.setdefault(term, len(vocab))
+            new_terms.extend([col] * len(term_rows))
+            new_rows.extend(term_rows)
+            new_tfs.extend(self._term_tfs[term])
+        terms = np.concatenate([np.repeat(np.arange(len(self._vocab)), np.diff(self._indptr)),
+                                np.array(new_terms, dtype=np.int64)])
+        # Stable, so each term keeps its rows in ascending order.
+        order = np.argsort(terms, kind="stable")
+        self._posting_rows = np.concatenate([self._posting_rows, np.array(new_rows, dtype=np.int64)])[order]
+        self._posting_tfs = np.concatenate([self._posting_tfs, np.array(new_tfs, dtype=np.float32)])[order]
+        self._indptr = np.concatenate([[0], np.cumsum(np.bincount(terms, minlength=len(vocab)))]).astype(np.int64)
+        self._vocab = vocab
+        self._term_rows.clear()
+        self._term_tfs.clear()
+
+    def _freeze(self):
+        with self._lock:
+            if self._frozen is not None:
+                return self._frozen
+            self._merge_postings()
+            alive = np.array(self._alive, dtype=bool)
+            lengths = np.array(self._lengths, dtype=np.float32)
+            if len(self._vectors) > 1:
+                if self.dense_quantization:
+                    merged = self._vectors[0]
+                    for block in self._vectors[1:]:
+                        merged = merged.append(block)
+                    self._vectors = [merged]
+                else:
+                    self._vectors = [np.vstack(self._vectors)]
+            dense = self._vectors[0] if self._vectors else None
+
+            vocab, indptr, rows, tfs = self._vocab, self._indptr, self._posting_rows, self._posting_tfs
+
+            n_alive = int(alive.sum())
+            avg_length = float(lengths[alive].mean()) if n_alive else 1.0
+            entry_alive = alive[rows] if len(rows) else np.zeros(0, dtype=bool)
+            df = np.add.reduceat(entry_alive.astype(np.float32), indptr[:-1]) if len(rows) else np.zeros(0)
+            df[np.diff(indptr) == 0] = 0
+            idf = np.log((n_alive - df + 0.5) / (df + 0.5) + 1)
+            term_of_entry = np.repeat(np.arange(len(vocab)), np.diff(indptr))
+            norm = self.k1 * (1 - self.b + self.b * lengths[rows] / avg_length) if len(rows) else 0
+            weights = idf[term_of_entry] * tfs * (self.k1 + 1) / (tfs + norm) if len(rows) else tfs
+            weights = np.where(entry_alive, weights, 0).astype(np.float32)
+
+            self._frozen = {"alive": alive, "dense": dense, "vocab": vocab, "indptr": indptr,
+                            "rows": rows, "weights": weights}
+            return self._frozen
+
+    def sparse_scores(self, query_texts):
+        frozen = self._freeze()
+        scores = np.zeros((len(query_texts), len(frozen["alive"])), dtype=np.float32)
+        indptr, rows, weights = frozen["indptr"], frozen["rows"], frozen["weights"]
+        for qi, text in enumerate(query_texts):
+            cols = [frozen["vocab"][term] for term in default_preprocess(text) if term in frozen["vocab"]]
+            if not cols:
+                continue
+            entries = np.concatenate([np.arange(indptr[col], indptr[col + 1]) for col in cols])
+            np.add.at(scores[qi], rows[entries], weights[entries])
+        return scores
+
+    def dense_scores(self, query_vectors):
+        frozen = self._freeze()
+        queries = np.asarray(query_vectors, dtype=np.float32)
+        queries = queries / np.maximum(np.linalg.norm(queries, axis=1, keepdims=True), 1e-12)
+        if frozen["dense"] is None:
+            return np.zeros((len(queries), len(frozen["alive"])), dtype=np.float32)
+        if self.dense_quantization:
+            return frozen["dense"].scores(queries)
+        return queries @ frozen["dense"].T
+
+    def _rescore_dense(self, dense, query_vectors, alive, depth):
+        # Keep exact float scores for the top approximate candidates only.
+        queries = np.asarray(query_vectors, dtype=np.float32)
+        queries = queries / np.maximum(np.linalg.norm(queries, axis=1, keepdims=True), 1e-12)
+        n_candidates = min(depth * self.rescore_factor, int(alive.sum()))
+        ranked = np.where(alive, dense, -np.inf)
+        candidates = np.argpartition(-ranked, n_candidates - 1, axis=1)[:, :n_candidates]
+        rescored = np.full_like(dense, -np.inf)
+        for qi, rows in enumerate(candidates):
+            vectors = np.asarray(self.vector_source([self.ids[row] for row in rows]), dtype=np.float32)
+            vectors = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+            rescored[qi, rows] = vectors @ queries[qi]
+        return rescored
+
+    def search(self, query_texts, query_vectors, k=3, weights=(0.5, 0.5), depth=None, c=60):
+        """
+        Scores a batch of queries against every chunk with both signals and
+        fuses them with weighted reciprocal rank fusion over the top `depth`
+        hits of each signal (default: k, as EnsembleRetriever does).
+
+        Returns one list per query of dicts with the chunk id, text, metadata,
+        fused score and the per-signal sparse and dense scores.
+        """
+        frozen = self._freeze()
+        alive = frozen["alive"]
+        n_queries = len(query_texts)
+        if not alive.any():
+            return [[] for _ in range(n_queries)]
+        depth = min(depth or k, int(alive.sum()))
+        sparse = self.sparse_scores(query_texts)
+        dense = self.dense_scores(query_vectors)
+        if self.dense_quantization and self.vector_source is not None:
+            dense = self._rescore_dense(dense, query_vectors, alive, depth)
+
+        fused = np.zeros_like(sparse)
+        query_index = np.arange(n_queries)[:, None]
+        for signal, weight, valid in ((sparse, weights[0], (sparse > 0) & alive),
+                                      (dense, weights[1], np.isfinite(dense) & alive)):
+            ranked = np.where(valid, signal, -np.inf)
+            top = np.argpartition(-ranked, depth - 1, axis=1)[:, :depth]
+            order = np.argsort(-ranked[query_index, top], axis=1)
+            top = top[query_index, order]
+            contribution = weight / (c + np.arange(1, depth + 1, dtype=np.float32))
+            fused[query_index, top] += np.where(valid[query_index, top], contribution, 0)
+
+        k = min(k, int(alive.sum()))
+        top = np.argpartition(-fused, k - 1, axis=1)[:, :k]
+        order = np.argsort(-fused[query_index, top], axis=1)
+        top = top[query_index, order]
+
+        results = []
+        for qi in range(n_queries):
+            hits = []
+            for row in top[qi]:
+                if fused[qi, row] <= 0:
+                    continue
+                dense_score = float(dense[qi, row]) if np.isfinite(dense[qi, row]) else None
+                hits.append({"id": self.ids[row], "text": self.texts[row], "metadata": self.metadatas[row],
+                             "score": float(fused[qi, row]), "sparse_score": float(sparse[qi, row]),
+                             "dense_score": dense_score})
+            results.append(hits)
+        return results
+
+
+class HybridRetriever(BaseRetriever):
+    """
+    Retriever over a HybridIndex; replaces EnsembleRetriever(BM25, Chroma).
+    """
+    index: HybridIndex
+    embeddings: Embeddings
+    k: int = 3
+    weights: List[float] = [0.5, 0.5]
+    depth: Optional[int] = None
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        return self.batch_search([query])[0]
+
+    def batch_search(self, queries):
+        # embed_query, not embed_documents: the query instruction differs from the passage one.
+        vectors = [self.embeddings.embed_query(query) for query in queries]
+        results = self.index.search(queries, vectors, k=self.k, weights=self.weights, depth=self.depth)
+        return [[Document(page_content=hit["text"],
+                          metadata=dict(hit["metadata"], score=hit["score"], sparse_score=hit["sparse_score"],
+                                        dense_score=hit["dense_score"]))
+                 for hit in hits] for hits in results]
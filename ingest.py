@@ -0,0 +1,107 @@
+"""
+Bulk ingestion of a directory tree of judgments into the QA stores
+(Chroma vector store and BM25 index).
+
+    python ingest.py path/to/judgments --workers 8 --batch-size 64
+
+Progress is checkpointed after every round of files, so an interrupted run
+resumes where it stopped when started again with the same checkpoint file.
+Files that cannot be read (corrupt PDFs, bad encodings) are recorded in the
+checkpoint as failed and skipped on resume until they change, or retried
+with --retry-failed.
+Run the web app with CASESAGE_RESET_QA_STORE=0 so it keeps the ingested stores.
+"""
+import os
+import json
+import time
+import argparse
+from legal_processor import LegalDocumentProcessor
+
+SUPPORTED_EXTENSIONS = (".pdf", ".txt", ".doc", ".docx")
+
+
+def find_files(root):
+    for dirpath, _, filenames in os.walk(root):
+        for filename in sorted(filenames):
+            if filename.lower().endswith(SUPPORTED_EXTENSIONS):
+                yield os.path.normpath(os.path.join(dirpath, filename))
+
+
+def load_checkpoint(checkpoint_path, retry_failed=False):
+    """
+    Returns {path: fingerprint} of the files the checkpoint records as
+    ingested, or as failed unless retry_failed is set. Later lines win.
+    """
+    done = {}
+    if os.path.exists(checkpoint_path):
+        with open(checkpoint_path, "r", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    entry = json.loads(line)
+                    if retry_failed and entry.get("status") == "failed":
+                        done.pop(entry["path"], None)
+                    else:
+                        done[entry["path"]] = tuple(entry["fingerprint"])
+    return done
+
+
+def ingest(root, checkpoint_path, workers=None, embed_concurrency=2, batch_size=32, round_size=200,
+           retry_failed=False):
+    processor = LegalDocumentProcessor()
+    done = load_checkpoint(checkpoint_path, retry_failed)
+    pending = [path for path in find_files(root)
+               if done.get(path) != processor.file_fingerprint(path)]
+    print(f"{len(pending)} file(s) to ingest, {len(done)} already done")
+
+    totals = {"files": 0, "failed": 0, "chunks": 0, "embedded": 0, "skipped": 0, "deleted": 0}
+    start = time.perf_counter()
+    with open(checkpoint_path, "a", encoding="utf-8") as checkpoint:
+        for i in range(0, len(pending), round_size):
+            round_paths = pending[i:i + round_size]
+            report = processor.store_in_chroma(round_paths, parse_workers=workers,
+                                               embed_concurrency=embed_concurrency, batch_size=batch_size)
+            # The round is persisted, so record its files as done (or failed).
+            for path in round_paths:
+                entry = {"path": path, "fingerprint": processor.file_fingerprint(path)}
+                if path in report["failed_files"]:
+                    entry.update(status="failed", error=report["failed_files"][path])
+                checkpoint.write(json.dumps(entry) + "\n")
+            checkpoint.flush()
+
+            for key in ("files", "failed", "embedded", "skipped", "deleted"):
+                totals[key] += report[key]
+            totals["chunks"] += report["embedded"] + report["skipped"]
+            elapsed = time.perf_counter() - start
+            print(f"[{min(i + round_size, len(pending))}/{len(pending)}] "
+                  f"{totals['files'] / elapsed:.2f} docs/sec, {totals['chunks'] / elapsed:.1f} chunks/sec "
+                  f"({totals['embedded']} embedded, {totals['skipped']} skipped, {totals['failed']} file(s) failed)")
+
+    elapsed = time.perf_counter() - start
+    totals["seconds"] = elapsed
+    if elapsed > 0:
+        totals["docs_per_sec"] = totals["files"] / elapsed
+        totals["chunks_per_sec"] = totals["chunks"] / elapsed
+    return totals
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bulk-ingest a directory of judgments for question answering.")
+    parser.add_argument("root", help="directory tree containing PDF, Word or TXT judgments")
+    parser.add_argument("--checkpoint", default="legal_ingest_checkpoint.jsonl",
+                        help="file recording ingested files, used to resume interrupted runs")
+    parser.add_argument("--workers", type=int, default=None, help="parse worker processes (default: CPU count)")
+    parser.add_argument("--embed-concurrency", type=int, default=2, help="concurrent embedding requests")
+    parser.add_argument("--batch-size", type=int, default=32, help="chunks per embedding request")
+    parser.add_argument("--round-size", type=int, default=200, help="files ingested between checkpoints")
+    parser.add_argument("--retry-failed", action="store_true",
+                        help="ingest again files the checkpoint records as failed")
+    args = parser.parse_args()
+
+    totals = ingest(args.root, args.checkpoint, workers=args.workers, embed_concurrency=args.embed_concurrency,
+                    batch_size=args.batch_size, round_size=args.round_size, retry_failed=args.retry_failed)
+    print(json.dumps(totals, indent=2))
+
+
+if __name__ == "__main__":
+    main()
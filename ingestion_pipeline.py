@@ -0,0 +1,166 @@
+import os
+import time
+import queue
+import logging
+import threading
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
+
+_worker_processor = None
+
+
+def _chunk_file(file_path, chunk_size, chunk_overlap):
+    # Runs in a parse worker process; each worker keeps its own processor.
+    global _worker_processor
+    if _worker_processor is None:
+        from legal_processor import LegalDocumentProcessor
+        _worker_processor = LegalDocumentProcessor()
+    return _worker_processor.create_chunks(file_path, chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+
+
+class EmbeddingPipeline:
+    """
+    Multi-file ingestion pipeline for LegalDocumentProcessor.
+
+    A process pool parses and chunks files while a fixed number of embedder
+    threads send chunk batches of `batch_size` to the embedding model and write
+    them to the vector store. At most `max_pending_batches` batches and
+    `2 * parse_workers` files are in flight at once, so memory stays flat no
+    matter how many files are ingested.
+    """
+
+    def __init__(self, processor, parse_workers=None, embed_concurrency=2, batch_size=32,
+                 max_pending_batches=8, chunk_size=1000, chunk_overlap=200):
+        self.processor = processor
+        self.parse_workers = parse_workers or os.cpu_count() or 1
+        self.embed_concurrency = embed_concurrency
+        self.batch_size = batch_size
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        self._batches = queue.Queue(maxsize=max_pending_batches)
+        self._errors = []
+        self._embedded = 0
+        # Batches of each planned file (by position) not written yet.
+        self._remaining = {}
+        # (file_path, error message) of files that could not be parsed.
+        self.failed = []
+        self._count_lock = threading.Lock()
+
+    def run(self, file_paths):
+        """
+        Ingests the given files and returns a report with the number of files
+        ingested and failed, chunks processed (embedded / skipped / deleted)
+        and elapsed seconds. Files that cannot be parsed are logged, listed
+        with their error under "failed_files" and left out; they do not stop
+        the run.
+
+        A file is recorded in the manifest, and chunks of its earlier version
+        deleted, only after all its new chunks are written. If embedding
+        fails, files not fully written are rolled back and the error raised.
+        """
+        start = time.perf_counter()
+        self.failed = []
+        self._remaining = {}
+        report = {"files": 0, "failed": 0, "embedded": 0, "skipped": 0, "deleted": 0}
+        plans = []
+        embedders = [threading.Thread(target=self._embed_worker, daemon=True)
+                     for _ in range(self.embed_concurrency)]
+        for thread in embedders:
+            thread.start()
+        try:
+            for file_path, chunks in self._parse(file_paths):
+                if self._errors:
+                    break
+                plan = self.processor.plan_chroma_upsert(file_path, chunks)
+                n_batches = -(-len(plan.new_chunks) // self.batch_size)
+                with self._count_lock:
+                    self._remaining[len(plans)] = n_batches
+                for i in range(0, len(plan.new_chunks), self.batch_size):
+                    # Blocks while the embedders are behind (backpressure).
+                    self._batches.put((len(plans), plan.new_ids[i:i + self.batch_size],
+                                       plan.new_chunks[i:i + self.batch_size]))
+                plans.append(plan)
+                report["files"] += 1
+                report["skipped"] += plan.skipped
+        finally:
+            for _ in embedders:
+                self._batches.put(None)
+            for thread in embedders:
+                thread.join()
+            report["deleted"] = self._finish(plans)
+        if self._errors:
+            raise self._errors[0]
+        report["failed"] = len(self.failed)
+        report["failed_files"] = dict(self.failed)
+        report["embedded"] = self._embedded
+        report["seconds"] = time.perf_counter() - start
+        return report
+
+    def _finish(self, plans):
+        # Commits the files whose batches were all written, rolls back the rest, and saves the indexes.
+        deleted = 0
+        for n, plan in enumerate(plans):
+            if self._remaining[n] == 0:
+                deleted += self.processor.commit_upsert(plan)
+            else:
+                self.processor.discard_upsert(plan)
+        self.processor.persist_indexes()
+        return deleted
+
+    def _parse(self, file_paths):
+        file_paths = [os.path.normpath(file_path) for file_path in file_paths]
+        if self.parse_workers <= 1 or len(file_paths) <= 1:
+            for file_path in file_paths:
+                chunks = self._safe_chunks(file_path, lambda: self.processor.create_chunks(
+                    file_path, chunk_size=self.chunk_size, chunk_overlap=self.chunk_overlap))
+                if chunks is not None:
+                    yield file_path, chunks
+            return
+
+        pending_paths = iter(file_paths)
+        with ProcessPoolExecutor(max_workers=self.parse_workers) as executor:
+            in_flight = {}
+            while True:
+                while len(in_flight) < 2 * self.parse_workers:
+                    file_path = next(pending_paths, None)
+                    if file_path is None:
+                        break
+                    future = executor.submit(_chunk_file, file_path, self.chunk_size, self.chunk_overlap)
+                    in_flight[future] = file_path
+                if not in_flight:
+                    break
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    file_path = in_flight.pop(future)
+                    chunks = self._safe_chunks(file_path, future.result)
+                    if chunks is not None:
+                        yield file_path, chunks
+
+    def _safe_chunks(self, file_path, get_chunks):
+        # Any error reading one file (unsupported format, corrupt PDF, bad encoding) fails only that file.
+        try:
+            return get_chunks()
+        except BrokenProcessPool:
+            raise
+        except Exception as e:
+            logging.warning(f"Error processing {file_path}: {type(e).__name__}: {e}")
+            self.failed.append((file_path, f"{type(e).__name__}: {e}"))
+            return None
+
+    def _embed_worker(self):
+        while True:
+            batch = self._batches.get()
+            if batch is None:
+                return
+            if self._errors:
+                continue
+            n, ids, chunks = batch
+            try:
+                vectors = self.processor.embeddings.embed_documents([chunk.page_content for chunk in chunks])
+                self.processor.write_chroma_batch(ids, chunks, vectors)
+            except Exception as e:
+                self._errors.append(e)
+                continue
+            with self._count_lock:
+                self._embedded += len(chunks)
+                self._remaining[n] -= 1
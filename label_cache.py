@@ -0,0 +1,115 @@
+import os
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+
+
+def label_key(model_version, sentence, context):
+    """
+    Cache key of one classifier input: a hash of the model version, the
+    sentence and its context window.
+    """
+    sha = hashlib.sha256()
+    for part in (model_version, sentence, context):
+        sha.update(part.encode("utf-8"))
+        sha.update(b"\0")
+    return sha.hexdigest()
+
+
+class LabelCache:
+    """
+    LRU cache of rhetorical-role labels keyed by label_key(), shared by all
+    requests. When `persist_path` is set the cache is loaded from that file
+    and put_many() appends only the new entries to it, one JSON line each,
+    outside the lock lookups take. The file is rewritten from memory once it
+    holds twice `max_entries` lines.
+    """
+
+    def __init__(self, max_entries=100000, persist_path=None):
+        self.max_entries = max_entries
+        self.persist_path = persist_path
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        # Serialises appends and compaction of the persisted log.
+        self._log_lock = threading.Lock()
+        self._log_lines = 0
+        if persist_path and os.path.exists(persist_path):
+            self._load()
+
+    def get_many(self, keys):
+        """
+        Returns the cached label of each key, or None for misses.
+        """
+        labels = []
+        with self._lock:
+            for key in keys:
+                label = self._entries.get(key)
+                if label is None:
+                    self.misses += 1
+                else:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                labels.append(label)
+        return labels
+
+    def put_many(self, keys, labels):
+        if not keys:
+            return
+        with self._lock:
+            self._insert(zip(keys, labels))
+        if self.persist_path:
+            self._append(keys, labels)
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses,
+                    "hit_rate": self.hits / total if total else 0.0}
+
+    def _insert(self, items):
+        for key, label in items:
+            self._entries[key] = label
+            self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _load(self):
+        rewrite = False
+        with open(self.persist_path, "r", encoding="utf-8") as f:
+            for line in f:
+                # A line without a newline was cut short by a crash mid-append,
+                # or is a cache saved before the log format (one JSON object).
+                rewrite = rewrite or not line.endswith("\n")
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                self._insert(entry.items() if isinstance(entry, dict) else [entry])
+                self._log_lines += 1
+        if rewrite:
+            # Later appends must start on a line of their own.
+            with self._log_lock:
+                self._compact()
+
+    def _append(self, keys, labels):
+        lines = "".join(json.dumps([key, label]) + "\n" for key, label in zip(keys, labels))
+        with self._log_lock:
+            os.makedirs(os.path.dirname(self.persist_path) or ".", exist_ok=True)
+            with open(self.persist_path, "a", encoding="utf-8") as f:
+                f.write(lines)
+            self._log_lines += len(keys)
+            if self._log_lines > 2 * self.max_entries:
+                self._compact()
+
+    def _compact(self):
+        # Drops evicted and overwritten entries from the log; called with _log_lock held.
+        with self._lock:
+            items = list(self._entries.items())
+        tmp_path = self.persist_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.writelines(json.dumps([key, label]) + "\n" for key, label in items)
+        os.replace(tmp_path, self.persist_path)
+        self._log_lines = len(items)
@@ -1,24 +1,135 @@
 import re
 import os
+import pickle
+import hashlib
+import threading
+from typing import NamedTuple
 import torch
 from langchain_community.embeddings import OllamaEmbeddings
 from langchain_community.vectorstores import Chroma
-from langchain_community.retrievers import BM25Retriever
-from langchain.retrievers import EnsembleRetriever
 from langchain_ollama import ChatOllama
 from langchain.prompts import PromptTemplate
 from langchain_core.output_parsers import StrOutputParser
+from langchain_core.documents import Document
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain.document_loaders import PyPDFLoader, UnstructuredWordDocumentLoader, TextLoader
+from bm25_index import BM25Index
+from hybrid_search import HybridIndex, HybridRetriever
+
+# Bump when the parsing or chunking logic changes to invalidate cached results.
+PARSER_VERSION = 1
+
+class UpsertPlan(NamedTuple):
+    """
+    What ingesting one file will write: every chunk ID of the file, and the
+    new chunks (with their IDs) that still need embedding.
+    """
+    doc_key: str
+    doc_hash: str
+    fingerprint: tuple
+    ids: list
+    new_ids: list
+    new_chunks: list
+    skipped: int
 
 class LegalDocumentProcessor:
     def __init__(self, storage_folder="tmp"):
         self.storage_folder = storage_folder
         self.vector_store_directory = "legal_db"
+        # Manifest of indexed files and the hybrid (BM25 + dense) arrays, persisted next to the vector store.
+        self.bm25_index_path = os.path.join("legal_bm25", "index.pkl")
+        self.hybrid_index_path = os.path.join("legal_bm25", "hybrid.pkl")
+        # Parsed documents and chunks, keyed by file content hash.
+        self.parsed_cache_directory = "legal_parsed"
         # Use OllamaEmbeddings by default; alternatively, you can use HuggingFaceEmbeddings.
-        self.embeddings = OllamaEmbeddings(model="nomic-embed-text")
+        # OLLAMA_BASE_URL can point ingestion at another (or a fake) embedding server.
+        self.embeddings = OllamaEmbeddings(model="nomic-embed-text",
+                                           base_url=os.environ.get("OLLAMA_BASE_URL", "http://localhost:11434"))
+        # Vector store client and sparse index are opened once and updated in place.
+        self._chroma_db = None
+        self._bm25_index = None
+        self._hybrid_index = None
+        self._lock = threading.RLock()
+        self._write_lock = threading.Lock()
+
+    def get_vector_store(self):
+        with self._lock:
+            if self._chroma_db is None:
+                self._chroma_db = Chroma(persist_directory=self.vector_store_directory,
+                                         embedding_function=self.embeddings)
+            return self._chroma_db
+
+    def get_bm25_index(self):
+        with self._lock:
+            if self._bm25_index is None:
+                self._bm25_index = BM25Index.load(self.bm25_index_path)
+            return self._bm25_index
     
-    def extract_case_number_and_split(self, file_path):
+    def get_hybrid_index(self):
+        """
+        Returns the hybrid (BM25 + dense) index over the chunks in the vector
+        store, loaded from disk on first use. Writes to the vector store are
+        mirrored into it and saved by persist_indexes().
+        """
+        with self._lock:
+            if self._hybrid_index is None:
+                # CASESAGE_QA_VECTOR_QUANTIZATION=int8|binary keeps only a quantized copy of the
+                # chunk vectors in memory; candidates are rescored with vectors read from Chroma.
+                options = dict(dense_quantization=os.environ.get("CASESAGE_QA_VECTOR_QUANTIZATION"),
+                               vector_source=self.chunk_vectors)
+                index = HybridIndex.load(self.hybrid_index_path, **options)
+                if index is None:
+                    # No saved index (an older store, or another quantization): build it once from Chroma.
+                    index = HybridIndex(**options)
+                    stored = self.get_vector_store().get(include=["embeddings", "documents", "metadatas"])
+                    if stored["ids"]:
+                        index.add(stored["ids"], stored["documents"], stored["metadatas"], stored["embeddings"])
+                        index.save(self.hybrid_index_path)
+                self._hybrid_index = index
+            return self._hybrid_index
+
+    def chunk_vectors(self, ids):
+        # Chroma does not return rows in the order the ids were requested.
+        stored = self.get_vector_store().get(ids=list(ids), include=["embeddings"])
+        by_id = dict(zip(stored["ids"], stored["embeddings"]))
+        return [by_id[id_] for id_ in ids]
+
+    def corpus_version(self):
+        # Changes on every upload that adds or replaces a document.
+        return self.get_bm25_index().version()
+
+    def _read_cache(self, name):
+        path = os.path.join(self.parsed_cache_directory, name)
+        try:
+            with open(path, "rb") as f:
+                return pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+
+    def _write_cache(self, name, value):
+        os.makedirs(self.parsed_cache_directory, exist_ok=True)
+        path = os.path.join(self.parsed_cache_directory, name)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+
+    def extract_case_number_and_split(self, file_path, content_hash=None):
+        """
+        Returns (header, judgment, case_number) for a file. Results are cached
+        on disk by file content hash, so an unchanged file is parsed only once.
+        """
+        if not file_path.lower().endswith((".pdf", ".docx", ".doc", ".txt")):
+            raise ValueError("Unsupported file format. Only PDF, Word, and TXT files are supported.")
+        content_hash = content_hash or self.file_content_hash(file_path)
+        cache_name = f"{content_hash}.v{PARSER_VERSION}.parsed.pkl"
+        parsed = self._read_cache(cache_name)
+        if parsed is None:
+            parsed = self._parse_document(file_path)
+            self._write_cache(cache_name, parsed)
+        return parsed
+
+    def _parse_document(self, file_path):
         if file_path.lower().endswith((".pdf", ".docx", ".doc", ".txt", ".PDF")):
             if file_path.lower().endswith(".pdf"):
                 loader = PyPDFLoader(file_path)
@@ -51,7 +162,21 @@ class LegalDocumentProcessor:
             raise ValueError("Unsupported file format. Only PDF, Word, and TXT files are supported.")
 
     def create_chunks(self, file_path, chunk_size=1000, chunk_overlap=200):
-        header, judgment, case_number = self.extract_case_number_and_split(file_path)
+        """
+        Splits a file into chunk Documents. Chunks are cached on disk by file
+        content hash and chunking parameters.
+        """
+        content_hash = self.file_content_hash(file_path)
+        cache_name = f"{content_hash}.v{PARSER_VERSION}.{chunk_size}-{chunk_overlap}.chunks.pkl"
+        cached = self._read_cache(cache_name)
+        if cached is not None:
+            return [Document(page_content=text, metadata=metadata) for text, metadata in cached]
+        docs = self._split(*self.extract_case_number_and_split(file_path, content_hash),
+                           chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+        self._write_cache(cache_name, [(doc.page_content, dict(doc.metadata)) for doc in docs])
+        return docs
+
+    def _split(self, header, judgment, case_number, chunk_size, chunk_overlap):
         splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
         metadata = [{"source": case_number}]
         docs = []
@@ -74,25 +199,209 @@ class LegalDocumentProcessor:
                 print(f"Error processing {file_path}: {e}")
         return all_docs
 
-    def store_in_chroma(self, file_paths):
-        chunks = self.add_new_files(file_paths)
-        chroma_db = Chroma.from_documents(chunks, self.embeddings, persist_directory=self.vector_store_directory)
-        chroma_db.persist()
-        print(f"File(s) saved to {self.vector_store_directory}")
-
-    def setup_retrievers(self):
-        # Load the persisted vector store.
-        chroma_db = Chroma(persist_directory=self.vector_store_directory, embedding_function=self.embeddings)
-        # Process documents from the storage folder (fallback)
-        print([os.path.join(self.storage_folder, f) for f in os.listdir(self.storage_folder)
-                                        if os.path.isfile(os.path.join(self.storage_folder, f))])
-        documents = self.add_new_files([os.path.join(self.storage_folder, f) for f in os.listdir(self.storage_folder)
-                                        if os.path.isfile(os.path.join(self.storage_folder, f))])
-        bm25_retriever = BM25Retriever.from_documents(documents)
-        bm25_retriever.k = 3
-        chroma_retriever = chroma_db.as_retriever(search_kwargs={"k": 3})
-        ensemble_retriever = EnsembleRetriever(retrievers=[bm25_retriever, chroma_retriever], weights=[0.5, 0.5])
-        return ensemble_retriever
+    @staticmethod
+    def file_fingerprint(file_path):
+        stat = os.stat(file_path)
+        return stat.st_size, stat.st_mtime_ns
+
+    @staticmethod
+    def file_content_hash(file_path):
+        sha = hashlib.sha256()
+        with open(file_path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                sha.update(block)
+        return sha.hexdigest()
+
+    @staticmethod
+    def doc_key(file_path):
+        # One key per file however it is reached (relative upload path, absolute path, symlink);
+        # the same key is used by BM25Index.files and the chunk metadata.
+        return os.path.realpath(file_path)
+
+    @staticmethod
+    def chunk_ids(doc_hash, chunks):
+        """
+        Derives a stable ID for every chunk from the document hash, the chunk
+        position and the chunk content hash, so identical content maps to
+        identical IDs whatever name or path the file was uploaded under.
+        """
+        ids = []
+        for position, chunk in enumerate(chunks):
+            chunk_hash = hashlib.sha256(chunk.page_content.encode("utf-8")).hexdigest()
+            ids.append(hashlib.sha256(f"{doc_hash}:{position}:{chunk_hash}".encode("utf-8")).hexdigest())
+        return ids
+
+    def plan_chroma_upsert(self, file_path, chunks):
+        """
+        Works out which chunks of one file still need embedding. Nothing is
+        deleted or recorded in the manifest until commit_upsert().
+        """
+        chroma_db = self.get_vector_store()
+        doc_key = self.doc_key(file_path)
+        fingerprint = self.file_fingerprint(file_path)
+        doc_hash = self.file_content_hash(file_path)
+        ids = self.chunk_ids(doc_hash, chunks)
+        for chunk in chunks:
+            chunk.metadata.update(doc_key=doc_key, doc_hash=doc_hash)
+
+        hybrid_index = self.get_hybrid_index()
+        with self._write_lock:
+            existing_ids = set(chroma_db.get(ids=ids, include=[])["ids"]) if ids else set()
+            # Stored chunks the saved hybrid index lacks (a run interrupted before it was saved).
+            missing_ids = [id_ for id_ in ids if id_ in existing_ids and id_ not in hybrid_index]
+            if missing_ids:
+                stored = chroma_db.get(ids=missing_ids, include=["embeddings", "documents", "metadatas"])
+                hybrid_index.add(stored["ids"], stored["documents"], stored["metadatas"], stored["embeddings"])
+
+        new_ids = [id_ for id_ in ids if id_ not in existing_ids]
+        new_chunks = [chunk for id_, chunk in zip(ids, chunks) if id_ not in existing_ids]
+        return UpsertPlan(doc_key, doc_hash, fingerprint, ids, new_ids, new_chunks, len(chunks) - len(new_chunks))
+
+    def commit_upsert(self, plan):
+        """
+        Finishes ingesting a file once all its new chunks are written: deletes
+        chunks left over from an earlier version of it and records it in the
+        manifest. Returns the number of chunks deleted.
+        """
+        with self._write_lock:
+            stale_ids = self._release_stale_chunks(plan.doc_key, set(plan.ids))
+            self.get_bm25_index().add_file(plan.doc_key, plan.fingerprint, plan.doc_hash)
+        return len(stale_ids)
+
+    def discard_upsert(self, plan):
+        """
+        Removes the chunks a failed ingest of a file managed to write; the
+        earlier version of the file, if any, stays indexed.
+        """
+        with self._write_lock:
+            chroma_db = self.get_vector_store()
+            stored = chroma_db.get(ids=plan.new_ids, include=["metadatas"]) if plan.new_ids else {"ids": []}
+            # Chunks another file has written since belong to it now.
+            written_ids = [id_ for id_, metadata in zip(stored["ids"], stored.get("metadatas") or [])
+                           if metadata.get("doc_key") == plan.doc_key]
+            if written_ids:
+                chroma_db.delete(ids=written_ids)
+                self.get_hybrid_index().remove(written_ids)
+
+    def _release_stale_chunks(self, doc_key, keep_ids):
+        """
+        Deletes the chunks recorded under doc_key that are not in keep_ids.
+        Chunks whose content another indexed file still has are handed over to
+        that file instead. Returns the IDs deleted. Caller holds _write_lock.
+        """
+        chroma_db = self.get_vector_store()
+        stored = chroma_db.get(where={"doc_key": doc_key}, include=["metadatas"])
+        stale_ids, handed_over = [], {}
+        for id_, metadata in zip(stored["ids"], stored["metadatas"]):
+            if id_ in keep_ids:
+                continue
+            owner = self.get_bm25_index().find_content(metadata.get("doc_hash"), exclude=doc_key)
+            if owner is None:
+                stale_ids.append(id_)
+            else:
+                handed_over.setdefault(owner, []).append((id_, metadata))
+        for owner, rows in handed_over.items():
+            chroma_db._collection.update(ids=[id_ for id_, _ in rows],
+                                         metadatas=[dict(metadata, doc_key=owner) for _, metadata in rows])
+        if stale_ids:
+            chroma_db.delete(ids=stale_ids)
+            self.get_hybrid_index().remove(stale_ids)
+        return stale_ids
+
+    def write_chroma_batch(self, ids, chunks, vectors):
+        """
+        Writes a batch of already embedded chunks to the vector store and the
+        hybrid index.
+        """
+        with self._write_lock:
+            self.get_vector_store()._collection.upsert(
+                ids=ids,
+                embeddings=vectors,
+                metadatas=[chunk.metadata for chunk in chunks],
+                documents=[chunk.page_content for chunk in chunks],
+            )
+            self.get_hybrid_index().add(ids, [chunk.page_content for chunk in chunks],
+                                        [chunk.metadata for chunk in chunks], vectors)
+
+    def persist_indexes(self):
+        # The manifest goes last: a file is only recorded once its chunks are saved.
+        self.get_vector_store().persist()
+        self.get_hybrid_index().save(self.hybrid_index_path)
+        self.get_bm25_index().save()
+
+    def store_in_chroma(self, file_paths, **pipeline_options):
+        """
+        Indexes the given files in the vector store and the hybrid index through
+        the batched ingestion pipeline. Returns a dict with the number of chunks
+        embedded, skipped as already stored, and deleted as stale.
+        """
+        from ingestion_pipeline import EmbeddingPipeline
+        report = EmbeddingPipeline(self, **pipeline_options).run(file_paths)
+        print(f"File(s) saved to {self.vector_store_directory}: {report}")
+        return report
+
+    def setup_retrievers(self, k=3, weights=(0.5, 0.5), depth=None):
+        """
+        Returns a single-pass hybrid retriever scoring BM25 and dense
+        similarity over the same chunks. Files in the storage folder that are
+        not indexed yet (fallback) are ingested first.
+        """
+        index = self.get_bm25_index()
+        file_paths = [os.path.join(self.storage_folder, f) for f in os.listdir(self.storage_folder)
+                      if os.path.isfile(os.path.join(self.storage_folder, f))]
+        unindexed = [file_path for file_path in file_paths
+                     if not index.has_file(self.doc_key(file_path), self.file_fingerprint(file_path))]
+        if unindexed:
+            self.store_in_chroma(unindexed)
+        return HybridRetriever(index=self.get_hybrid_index(), embeddings=self.embeddings,
+                               k=k, weights=list(weights), depth=depth)
+
+class ThinkFilter:
+    """
+    Incrementally removes <think>...</think> spans from a token stream.
+    Tags may be split across tokens, so a possible partial tag at the end of
+    the buffer is held back until the next token arrives.
+    """
+    OPEN, CLOSE = "<think>", "</think>"
+
+    def __init__(self):
+        self.buffer = ""
+        self.in_think = False
+        self.started = False
+
+    def feed(self, text):
+        self.buffer += text
+        out = []
+        while True:
+            tag = self.CLOSE if self.in_think else self.OPEN
+            idx = self.buffer.find(tag)
+            if idx != -1:
+                if not self.in_think:
+                    out.append(self.buffer[:idx])
+                self.buffer = self.buffer[idx + len(tag):]
+                self.in_think = not self.in_think
+                continue
+            keep = 0
+            for n in range(min(len(tag) - 1, len(self.buffer)), 0, -1):
+                if tag.startswith(self.buffer[-n:]):
+                    keep = n
+                    break
+            if not self.in_think:
+                out.append(self.buffer[:len(self.buffer) - keep])
+            self.buffer = self.buffer[len(self.buffer) - keep:]
+            return self._visible("".join(out))
+
+    def flush(self):
+        rest = "" if self.in_think else self.buffer
+        self.buffer = ""
+        return self._visible(rest)
+
+    def _visible(self, text):
+        # Drop the whitespace the model emits between </think> and the answer.
+        if not self.started:
+            text = text.lstrip()
+            self.started = bool(text)
+        return text
 
 class RAGApplication:
     def __init__(self, retriever):
@@ -115,6 +424,23 @@ Answer:""",
         final_answer = re.sub(r'<think>.*?</think>', '', answer, flags=re.DOTALL).strip()
         return doc_texts, final_answer
 
+    def stream(self, question):
+        """
+        Yields ("sources", doc_texts) once retrieval is done, then ("token", text)
+        for each piece of the answer as it is generated, with <think> spans removed.
+        """
+        context = self.retriever.invoke(question)
+        doc_texts = [doc.page_content for doc in context]
+        yield "sources", doc_texts
+        think_filter = ThinkFilter()
+        for piece in self.rag_chain.stream({"question": question, "context": doc_texts}):
+            text = think_filter.feed(piece)
+            if text:
+                yield "token", text
+        text = think_filter.flush()
+        if text:
+            yield "token", text
+
 # def answer_question(file_path, question):
 #     """
 #     Given a legal document file_path and a question:
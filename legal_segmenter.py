@@ -0,0 +1,188 @@
+import re
+import time
+import json
+import argparse
+from typing import NamedTuple
+
+
+class Span(NamedTuple):
+    """
+    Character offsets [start, end) of a piece of a document. Spans are passed
+    around instead of substrings; call text() only when the text is needed.
+    """
+    start: int
+    end: int
+
+    def text(self, document):
+        return document[self.start:self.end]
+
+
+# Abbreviations that are never the last word of a sentence unless a line break follows.
+NON_TERMINAL_ABBREVIATIONS = {
+    "no", "nos", "mr", "mrs", "ms", "dr", "sh", "smt", "km", "st", "hon'ble", "honble", "j", "jj", "cj",
+    "v", "vs", "m/s", "messrs", "co", "pvt", "corpn", "bros", "govt", "dept", "regd",
+    "s", "ss", "sec", "secs", "art", "arts", "cl", "cls", "r", "rr", "o", "ord", "para", "paras",
+    "sch", "ch", "vol", "p", "pp", "pg", "rs", "ex", "ext", "fig", "viz", "cf", "ibid", "id",
+    "supp", "ed", "edn", "crl", "cri", "civ", "misc", "w", "wp", "slp", "cr", "cra", "app", "appl",
+    "ors", "anr", "approx", "illus", "expl", "sub", "cit", "ref", "ltd", "inc", "etc",
+}
+# Of those, the ones that often do end a sentence ("... and Ors. The appeal ...").
+TERMINAL_ABBREVIATIONS = {"ors", "anr", "ltd", "inc", "etc"}
+
+_CLOSERS = "\"')]}’”"
+_OPENERS = "\"'([{‘“"
+
+_CANDIDATE = re.compile(r"[.?!]+[\"')\]}’”]*(?=\s|\Z)")
+_BLANK_LINE = re.compile(r"\n[^\S\n]*\n")
+_SPACE = re.compile(r"\s*")
+_LAST_TOKEN = re.compile(r"\S*\Z")
+_ENUMERATOR = re.compile(r"\(?(\d{1,3}|[a-zA-Z]|[ivxlcIVXLC]{1,6})\)?$")
+# Only this much of the word before a full stop is looked at.
+_MAX_WORD = 48
+
+
+def _classify(word, first):
+    """
+    Classifies the word before a full stop: None when it cannot end a
+    sentence (a paragraph number opening the sentence), "terminal" when it
+    ends one only before a capitalised word, "abbreviation" when it needs a
+    line break to end one, else "regular".
+    """
+    word = word.rstrip(".").lstrip(_OPENERS + "&-/")
+    if first and _ENUMERATOR.match(word):
+        return None
+    lowered = word.lower()
+    if lowered in TERMINAL_ABBREVIATIONS:
+        return "terminal"
+    # Initials, "S.C.R.", "i.e.", "U.S.A." and the listed abbreviations.
+    if (lowered in NON_TERMINAL_ABBREVIATIONS or (len(word) == 1 and word.isalpha())
+            or ("." in word and not word.replace(".", "").isdigit())):
+        return "abbreviation"
+    return "regular"
+
+
+def _events(text):
+    # Candidate terminators and blank lines, in document order.
+    candidates = _CANDIDATE.finditer(text)
+    blanks = _BLANK_LINE.finditer(text)
+    candidate, blank = next(candidates, None), next(blanks, None)
+    while candidate or blank:
+        if blank is None or (candidate is not None and candidate.start() < blank.start()):
+            yield candidate, False
+            candidate = next(candidates, None)
+        else:
+            yield blank, True
+            blank = next(blanks, None)
+
+
+def segment_sentences(text):
+    """
+    Yields a Span per sentence of a judgment in one pass over the text.
+
+    A sentence ends at '?' or '!', or at a '.' that is not part of a legal
+    abbreviation ("No.", "Ltd.", "S.C.R.", "Hon'ble", initials), a paragraph
+    number ("1.", "(iv).") or a decimal, when the next word does not start in
+    lowercase. A line break after a full stop and a blank line always end
+    the sentence. Only full stops and blank lines are visited, so the cost is
+    linear in the length of the text and no substrings are built.
+    """
+    start = _SPACE.match(text).end()
+    for match, is_blank in _events(text):
+        if match.start() <= start:
+            continue
+        if is_blank:
+            end = match.start()
+            while end > start and text[end - 1].isspace():
+                end -= 1
+            yield Span(start, end)
+            start = _SPACE.match(text, match.end()).end()
+            continue
+        end = match.end()
+        next_start = _SPACE.match(text, end).end()
+        if next_start >= len(text):
+            break
+        terminator = text[match.start():end].rstrip(_CLOSERS)
+        if "?" in terminator or "!" in terminator:
+            kind = "strong"
+        else:
+            lo = max(start, match.start() - _MAX_WORD)
+            word = _LAST_TOKEN.search(text, lo, match.start()).group()
+            kind = _classify(word + terminator, first=match.start() - len(word) == start)
+        following = text[next_start]
+        if (kind is not None and ("\n" in text[end:next_start] or kind == "strong"
+                                  or (kind == "regular" and not following.islower())
+                                  or (kind == "terminal" and _starts_sentence(text, next_start)))):
+            yield Span(start, end)
+            start = next_start
+    end = len(text)
+    while end > start and text[end - 1].isspace():
+        end -= 1
+    if end > start:
+        yield Span(start, end)
+
+
+def _starts_sentence(text, position, limit=8):
+    for char in text[position:position + limit]:
+        if char.isalnum():
+            return char.isupper() or char.isdigit()
+    return True
+
+
+def naive_split(text):
+    """
+    The splitter semantic_module used before this one: a cut at every '.'
+    at least 30 characters after the last one, building each sentence a
+    character at a time. Kept for benchmark().
+    """
+    sentences = []
+    t = ""
+    start = 0
+    for i in range(len(text)):
+        if text[i] != '.' or ((i - start) < 30):
+            t += "'" if text[i] == "`" else text[i]
+            continue
+        if len(t) > 0:
+            sentences.append((start, i, t))
+        t = ""
+        start = i + 1
+    return sentences
+
+
+def benchmark(paths, scales=(1, 10, 100)):
+    """
+    Times naive_split() and segment_sentences() on the given judgments
+    repeated `scales` times, reporting sentences and characters per second.
+    """
+    texts = []
+    for path in paths:
+        with open(path, "r", encoding="utf-8") as f:
+            texts.append(f.read())
+    corpus = "\n\n".join(texts)
+    results = {}
+    for scale in scales:
+        text = "\n\n".join([corpus] * scale)
+        result = {"characters": len(text)}
+        for name, split in (("naive", naive_split), ("segmenter", lambda t: list(segment_sentences(t)))):
+            start = time.perf_counter()
+            sentences = split(text)
+            seconds = max(time.perf_counter() - start, 1e-9)
+            result[name] = {"sentences": len(sentences), "seconds": seconds,
+                            "sentences_per_sec": len(sentences) / seconds, "mb_per_sec": len(text) / seconds / 1e6}
+        results[f"x{scale}"] = result
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Split a judgment into sentences or benchmark the segmenter.")
+    parser.add_argument("command", choices=["split", "benchmark"])
+    parser.add_argument("files", nargs="*", default=["tmp/1973_T_9.txt"])
+    parser.add_argument("--scales", default="1,10,100")
+    args = parser.parse_args()
+    if args.command == "split":
+        for path in args.files:
+            with open(path, "r", encoding="utf-8") as f:
+                text = f.read()
+            for span in segment_sentences(text):
+                print(f"{span.start}\t{span.end}\t{' '.join(span.text(text).split())}")
+    else:
+        print(json.dumps(benchmark(args.files, [int(scale) for scale in args.scales.split(",")]), indent=2))
@@ -0,0 +1,156 @@
+import os
+import time
+import hashlib
+import threading
+import logging
+from collections import OrderedDict
+
+
+def estimate_model_size(obj):
+    """
+    Best-effort estimate of the resident size (in bytes) of a loaded model.
+    Handles torch modules, ONNX models, (tokenizer, model) tuples and spaCy
+    pipelines.
+    """
+    if obj is None:
+        return 0
+    if isinstance(obj, (tuple, list)):
+        return sum(estimate_model_size(o) for o in obj)
+    if hasattr(obj, "model_bytes"):
+        # ONNX Runtime sessions: the size of the model file.
+        return obj.model_bytes
+    if hasattr(obj, "parameters") and hasattr(obj, "buffers"):
+        size = 0
+        for tensor in list(obj.parameters()) + list(obj.buffers()):
+            size += tensor.numel() * tensor.element_size()
+        return size
+    if hasattr(obj, "pipeline") and hasattr(obj, "vocab"):
+        # spaCy pipeline: sum the weights of every trainable component.
+        size = 0
+        for _, component in obj.pipeline:
+            model = getattr(component, "model", None)
+            if model is None or not hasattr(model, "walk"):
+                continue
+            for node in model.walk():
+                for name in node.param_names:
+                    if node.has_param(name):
+                        size += node.get_param(name).nbytes
+        return size
+    return 0
+
+
+class ModelRegistry:
+    """
+    Process-wide registry that loads each model once and keeps it resident.
+
+    Models are registered with a loader callable and loaded lazily on first use
+    (or eagerly through preload()). When a memory budget is set, the least
+    recently used models are evicted until the resident total fits the budget.
+    """
+
+    def __init__(self, memory_budget=None):
+        self.memory_budget = memory_budget
+        self._loaders = {}
+        self._models = OrderedDict()
+        self._stats = {}
+        self._lock = threading.RLock()
+        self._load_locks = {}
+
+    def register(self, name, loader):
+        with self._lock:
+            self._loaders[name] = loader
+            self._load_locks.setdefault(name, threading.Lock())
+
+    def get(self, name):
+        with self._lock:
+            if name in self._models:
+                self._models.move_to_end(name)
+                self._stats[name]["hits"] += 1
+                return self._models[name]
+            if name not in self._loaders:
+                raise KeyError(f"No model registered under '{name}'")
+            load_lock = self._load_locks[name]
+
+        # Load outside the registry lock so other models stay available,
+        # but serialise concurrent loads of the same model.
+        with load_lock:
+            with self._lock:
+                if name in self._models:
+                    self._models.move_to_end(name)
+                    self._stats[name]["hits"] += 1
+                    return self._models[name]
+                loader = self._loaders[name]
+            start = time.perf_counter()
+            model = loader()
+            load_time = time.perf_counter() - start
+            size = estimate_model_size(model)
+            with self._lock:
+                self._models[name] = model
+                stats = self._stats.setdefault(name, {"loads": 0, "hits": 0})
+                stats.update(load_time=load_time, resident_bytes=size)
+                stats["loads"] += 1
+                logging.info(f"Loaded model '{name}' in {load_time:.2f}s ({size / 2**20:.1f} MiB)")
+                self._evict(keep=name)
+            return model
+
+    def preload(self, names=None):
+        for name in names or list(self._loaders):
+            self.get(name)
+
+    def evict(self, name):
+        with self._lock:
+            if self._models.pop(name, None) is not None:
+                self._stats[name]["resident_bytes"] = 0
+                logging.info(f"Evicted model '{name}'")
+
+    def resident_bytes(self):
+        with self._lock:
+            return sum(self._stats[name]["resident_bytes"] for name in self._models)
+
+    def stats(self):
+        """
+        Returns a dict of per-model statistics: load time (seconds), resident
+        size (bytes), number of loads and cache hits, and whether it is loaded.
+        """
+        with self._lock:
+            return {name: dict(stats, loaded=name in self._models)
+                    for name, stats in self._stats.items()}
+
+    def _evict(self, keep):
+        if not self.memory_budget:
+            return
+        for name in list(self._models):
+            if self.resident_bytes() <= self.memory_budget:
+                break
+            if name != keep:
+                self.evict(name)
+
+
+def model_revision(*paths):
+    """
+    Fingerprint of model files or directories on disk (relative names, sizes
+    and modification times), used to key caches of model outputs so they are
+    not reused after a model is replaced or retrained.
+    """
+    sha = hashlib.sha256()
+    for path in paths:
+        files = [path]
+        if os.path.isdir(path):
+            files = sorted(os.path.join(dirpath, filename)
+                           for dirpath, _, filenames in os.walk(path) for filename in filenames)
+        for file in files:
+            try:
+                stat = os.stat(file)
+            except OSError:
+                continue
+            sha.update(f"{os.path.relpath(file, path)}:{stat.st_size}:{stat.st_mtime_ns}\n".encode("utf-8"))
+    return sha.hexdigest()
+
+
+def _budget_from_env():
+    # Budget in MiB, e.g. CASESAGE_MODEL_MEMORY_MB=4096. Unset means unbounded.
+    value = os.environ.get("CASESAGE_MODEL_MEMORY_MB")
+    return int(value) * 2**20 if value else None
+
+
+registry = ModelRegistry(memory_budget=_budget_from_env())
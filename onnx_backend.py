@@ -0,0 +1,332 @@
+"""
+ONNX Runtime CPU backend for the rhetorical-role classifier and the
+similarity SentenceTransformer.
+
+    python onnx_backend.py export classifier      # ./saved_model/ -> onnx/role_classifier/
+    python onnx_backend.py export encoder         # fine_tuned_similarity_model_ver2.0 -> onnx/similarity_encoder/
+    python onnx_backend.py benchmark classifier   # latency, throughput and drift vs PyTorch
+    python onnx_backend.py benchmark encoder
+
+Export writes model.onnx (fp32) and model.int8.onnx (dynamic int8
+quantization of the weights) plus the tokenizer. The backend is chosen per
+model with CASESAGE_CLASSIFIER_BACKEND / CASESAGE_SIMILARITY_BACKEND
+("torch", "onnx" or "onnx-fp32").
+
+Export checks that the fp32 graph gives the PyTorch outputs on sentence
+pairs. Expected drift of the int8 models against PyTorch fp32, checked by
+the benchmark: at least 99% identical role labels, embeddings with cosine
+similarity >= 0.99 to the PyTorch ones, and at least 90% overlap of the
+top-10 neighbours.
+"""
+import os
+import json
+import time
+import logging
+import argparse
+import numpy as np
+
+ONNX_DIRECTORY = os.environ.get("CASESAGE_ONNX_DIRECTORY", "onnx")
+ONNX_THREADS = int(os.environ.get("CASESAGE_ONNX_THREADS", 0))
+BACKENDS = ("torch", "onnx", "onnx-fp32")
+
+LABEL_AGREEMENT_TOLERANCE = 0.99
+COSINE_TOLERANCE = 0.99
+NEIGHBOUR_OVERLAP_TOLERANCE = 0.9
+
+
+def _import_onnxruntime():
+    try:
+        import onnxruntime
+    except ImportError:
+        raise ImportError("The onnx backend requires onnxruntime: pip install onnxruntime onnx")
+    return onnxruntime
+
+
+def quantize(model_path, output_path):
+    _import_onnxruntime()
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+    quantize_dynamic(model_path, output_path, weight_type=QuantType.QInt8)
+
+
+# Graph inputs in the order of _KeywordInputs.forward; tokenizers may return them in another order.
+MODEL_INPUTS = ("input_ids", "attention_mask", "token_type_ids")
+
+
+def _keyword_inputs(model):
+    """
+    Wraps a transformers model so its inputs are bound by name.
+    torch.onnx.export passes inputs by position, and tokenizers and model
+    forward() signatures do not agree on the order (BERT tokenizers return
+    token_type_ids before attention_mask).
+    """
+    import torch
+
+    class KeywordInputs(torch.nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.model = model
+
+        def forward(self, input_ids, attention_mask, token_type_ids=None):
+            inputs = {"input_ids": input_ids, "attention_mask": attention_mask}
+            if token_type_ids is not None:
+                inputs["token_type_ids"] = token_type_ids
+            return self.model(**inputs, return_dict=False)[0]
+
+    return KeywordInputs()
+
+
+def _export(model, tokenizer, output_dir, output_name):
+    import inspect
+    import torch
+    os.makedirs(output_dir, exist_ok=True)
+    module = _keyword_inputs(model).eval()
+    # Sentence pairs, so token_type_ids differ from the attention mask and a mix-up shows in the check below.
+    sample = tokenizer(["An example sentence.", "Another one."], ["Its context, which is longer.", "More."],
+                       padding=True, return_tensors="pt")
+    unknown = set(sample.keys()) - set(MODEL_INPUTS)
+    if unknown:
+        raise ValueError(f"Tokenizer returns inputs the export does not handle: {sorted(unknown)}")
+    input_names = [name for name in MODEL_INPUTS if name in sample]
+    parameters = list(inspect.signature(module.forward).parameters)[:len(input_names)]
+    assert input_names == parameters, f"graph inputs {input_names} would bind to {parameters}"
+    dynamic_axes = {name: {0: "batch", 1: "sequence"} for name in input_names}
+    dynamic_axes[output_name] = {0: "batch"}
+    model_path = model_file(output_dir, quantized=False)
+    # quantize_dynamic's shape inference rejects graphs from the dynamo exporter, torch's default since 2.9.
+    options = {"dynamo": False} if "dynamo" in inspect.signature(torch.onnx.export).parameters else {}
+    with torch.inference_mode():
+        torch.onnx.export(module, tuple(sample[name] for name in input_names), model_path,
+                          input_names=input_names, output_names=[output_name], dynamic_axes=dynamic_axes,
+                          opset_version=14, do_constant_folding=True, **options)
+        expected = module(**sample).float().numpy()
+    session, _ = _session(output_dir, quantized=False)
+    exported_names = [node.name for node in session.get_inputs()]
+    assert exported_names == input_names, f"exported inputs {exported_names}, expected {input_names}"
+    exported = session.run([output_name], {name: sample[name].numpy() for name in input_names})[0]
+    if not np.allclose(exported, expected, atol=1e-3):
+        raise ValueError(f"Exported model differs from PyTorch by {np.abs(exported - expected).max():.4f}")
+    quantize(model_path, model_file(output_dir))
+    tokenizer.save_pretrained(output_dir)
+    return model_path
+
+
+def export_classifier(model_dir="./saved_model/", tokenizer_dir="./saved_tokenizer/",
+                      output_dir=os.path.join(ONNX_DIRECTORY, "role_classifier")):
+    from transformers import AutoTokenizer, AutoModelForSequenceClassification
+    model = AutoModelForSequenceClassification.from_pretrained(model_dir)
+    tokenizer = AutoTokenizer.from_pretrained(tokenizer_dir)
+    _export(model, tokenizer, output_dir, "logits")
+    with open(os.path.join(output_dir, "config.json"), "w", encoding="utf-8") as f:
+        json.dump({"num_labels": model.config.num_labels}, f)
+    return output_dir
+
+
+def export_sentence_encoder(model_path="fine_tuned_similarity_model_ver2.0",
+                            output_dir=os.path.join(ONNX_DIRECTORY, "similarity_encoder")):
+    """
+    Exports the transformer of a SentenceTransformer; pooling and
+    normalisation are read from its modules and applied in numpy.
+    """
+    from sentence_transformers import SentenceTransformer
+    model = SentenceTransformer(model_path, device="cpu")
+    pooling = model[1].get_config_dict()
+    _export(model[0].auto_model, model.tokenizer, output_dir, "token_embeddings")
+    with open(os.path.join(output_dir, "encoder.json"), "w", encoding="utf-8") as f:
+        json.dump({"max_seq_length": model.max_seq_length,
+                   "dimension": model.get_sentence_embedding_dimension(),
+                   "pooling": "cls" if pooling.get("pooling_mode_cls_token")
+                   else "max" if pooling.get("pooling_mode_max_tokens") else "mean",
+                   "normalize": any(type(module).__name__ == "Normalize" for module in model)}, f)
+    return output_dir
+
+
+def model_file(model_dir, quantized=True):
+    return os.path.join(model_dir, "model.int8.onnx" if quantized else "model.onnx")
+
+
+def _session(model_dir, quantized=True, threads=ONNX_THREADS):
+    onnxruntime = _import_onnxruntime()
+    options = onnxruntime.SessionOptions()
+    options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+    if threads:
+        options.intra_op_num_threads = threads
+    path = model_file(model_dir, quantized)
+    session = onnxruntime.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+    return session, path
+
+
+class OnnxSequenceClassifier:
+    """
+    Classifier exported by export_classifier(). predict() takes a padded
+    batch of numpy arrays and returns the logits.
+    """
+
+    def __init__(self, model_dir, quantized=True, threads=ONNX_THREADS):
+        self.session, self.model_path = _session(model_dir, quantized, threads)
+        self.model_bytes = os.path.getsize(self.model_path)
+        self.input_names = [node.name for node in self.session.get_inputs()]
+        with open(os.path.join(model_dir, "config.json"), "r", encoding="utf-8") as f:
+            self.num_labels = json.load(f)["num_labels"]
+
+    def predict(self, batch):
+        feed = {name: np.asarray(batch[name], dtype=np.int64) for name in self.input_names}
+        return self.session.run(["logits"], feed)[0]
+
+
+class OnnxSentenceEncoder:
+    """
+    Drop-in for the parts of SentenceTransformer this app uses: encode(),
+    tokenizer, max_seq_length and get_sentence_embedding_dimension().
+    """
+
+    def __init__(self, model_dir, quantized=True, threads=ONNX_THREADS):
+        from transformers import AutoTokenizer
+        self.session, self.model_path = _session(model_dir, quantized, threads)
+        self.model_bytes = os.path.getsize(self.model_path)
+        self.input_names = [node.name for node in self.session.get_inputs()]
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+        with open(os.path.join(model_dir, "encoder.json"), "r", encoding="utf-8") as f:
+            self.config = json.load(f)
+        self.max_seq_length = self.config["max_seq_length"]
+
+    def get_sentence_embedding_dimension(self):
+        return self.config["dimension"]
+
+    def _pool(self, token_embeddings, attention_mask):
+        if self.config["pooling"] == "cls":
+            return token_embeddings[:, 0]
+        mask = attention_mask[:, :, None].astype(np.float32)
+        if self.config["pooling"] == "max":
+            return np.where(mask > 0, token_embeddings, -1e9).max(axis=1)
+        return (token_embeddings * mask).sum(axis=1) / np.maximum(mask.sum(axis=1), 1e-9)
+
+    def encode(self, sentences, batch_size=32, convert_to_numpy=True, normalize_embeddings=False, **kwargs):
+        single = isinstance(sentences, str)
+        sentences = [sentences] if single else list(sentences)
+        vectors = np.zeros((len(sentences), self.get_sentence_embedding_dimension()), dtype=np.float32)
+        # Batches of similar length, as SentenceTransformer.encode does.
+        order = np.argsort([-len(sentence) for sentence in sentences], kind="stable")
+        for start in range(0, len(order), batch_size):
+            rows = order[start:start + batch_size]
+            batch = self.tokenizer([sentences[row] for row in rows], padding=True, truncation=True,
+                                   max_length=self.max_seq_length, return_tensors="np")
+            feed = {name: batch[name].astype(np.int64) for name in self.input_names}
+            token_embeddings = self.session.run(["token_embeddings"], feed)[0]
+            vectors[rows] = self._pool(token_embeddings, batch["attention_mask"])
+        if normalize_embeddings or self.config["normalize"]:
+            vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        return vectors[0] if single else vectors
+
+
+def load_backend(backend, model_dir, onnx_class, torch_loader):
+    """
+    Loads the ONNX model for `backend` "onnx" (int8) or "onnx-fp32", falling
+    back to torch_loader() when the model has not been exported.
+    """
+    if backend in ("onnx", "onnx-fp32"):
+        if os.path.exists(model_dir):
+            return onnx_class(model_dir, quantized=backend == "onnx")
+        logging.warning(f"No exported model in {model_dir}; run `python onnx_backend.py export`. Using PyTorch")
+    return torch_loader()
+
+
+def backend_model_path(backend, model_dir, torch_path):
+    """
+    Returns the model file (ONNX) or directory (PyTorch) load_backend()
+    loads for `backend`, without loading it.
+    """
+    if backend in ("onnx", "onnx-fp32") and os.path.exists(model_dir):
+        return model_file(model_dir, quantized=backend == "onnx")
+    return torch_path
+
+
+def _cosine_rows(a, b):
+    a = a / np.maximum(np.linalg.norm(a, axis=1, keepdims=True), 1e-12)
+    b = b / np.maximum(np.linalg.norm(b, axis=1, keepdims=True), 1e-12)
+    return (a * b).sum(axis=1)
+
+
+def _neighbours(vectors, k):
+    vectors = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+    scores = vectors @ vectors.T
+    np.fill_diagonal(scores, -np.inf)
+    return np.argsort(-scores, axis=1)[:, :k]
+
+
+def benchmark_classifier(filepath="tmp/1973_T_9.txt", batch_size=32):
+    """
+    Runs the role classifier over one judgment with PyTorch, ONNX fp32 and
+    ONNX int8, reporting latency, sentences/sec, label agreement with
+    PyTorch and the largest logit difference.
+    """
+    from semantic_module import iter_features, load_role_classifier, predict_logits
+    with open(filepath, "r", encoding="utf-8") as f:
+        features = list(iter_features(f.read()))
+    sentences = [sentence for _, _, sentence, _ in features]
+    contexts = [context for _, _, _, context in features]
+    torch_model, tokenizer = load_role_classifier()
+    directory = os.path.join(ONNX_DIRECTORY, "role_classifier")
+    results = {"sentences": len(sentences)}
+    reference = None
+    for name, model in (("torch", torch_model),
+                        ("onnx-fp32", OnnxSequenceClassifier(directory, quantized=False)),
+                        ("onnx-int8", OnnxSequenceClassifier(directory, quantized=True))):
+        start = time.perf_counter()
+        logits = predict_logits(model, tokenizer, sentences, contexts, batch_size=batch_size)
+        seconds = time.perf_counter() - start
+        reference = logits if reference is None else reference
+        agreement = float(np.mean(np.argmax(logits, axis=1) == np.argmax(reference, axis=1)))
+        results[name] = {"seconds": seconds, "sentences_per_sec": len(sentences) / seconds,
+                         "ms_per_batch": 1000 * seconds / max(1, -(-len(sentences) // batch_size)),
+                         "label_agreement": agreement,
+                         "max_logit_diff": float(np.abs(logits - reference).max()),
+                         "within_tolerance": agreement >= LABEL_AGREEMENT_TOLERANCE}
+    return results
+
+
+def benchmark_encoder(filepath="tmp/1973_T_9.txt", model_path="fine_tuned_similarity_model_ver2.0",
+                      batch_size=32, k=10):
+    """
+    Encodes the sentences of one judgment with PyTorch, ONNX fp32 and ONNX
+    int8, reporting latency, sentences/sec, cosine similarity to the
+    PyTorch embeddings and overlap of each sentence's top-k neighbours.
+    """
+    from sentence_transformers import SentenceTransformer
+    from legal_segmenter import segment_sentences
+    with open(filepath, "r", encoding="utf-8") as f:
+        text = f.read()
+    sentences = [span.text(text) for span in segment_sentences(text)]
+    directory = os.path.join(ONNX_DIRECTORY, "similarity_encoder")
+    results = {"sentences": len(sentences)}
+    reference = None
+    for name, model in (("torch", SentenceTransformer(model_path, device="cpu")),
+                        ("onnx-fp32", OnnxSentenceEncoder(directory, quantized=False)),
+                        ("onnx-int8", OnnxSentenceEncoder(directory, quantized=True))):
+        start = time.perf_counter()
+        vectors = model.encode(sentences, batch_size=batch_size, convert_to_numpy=True, normalize_embeddings=True)
+        seconds = time.perf_counter() - start
+        if reference is None:
+            reference, reference_neighbours = vectors, _neighbours(vectors, k)
+        cosine = _cosine_rows(vectors, reference)
+        overlap = np.mean([len(set(a) & set(b)) / k for a, b in zip(_neighbours(vectors, k), reference_neighbours)])
+        results[name] = {"seconds": seconds, "sentences_per_sec": len(sentences) / seconds,
+                         "min_cosine": float(cosine.min()), "mean_cosine": float(cosine.mean()),
+                         f"top{k}_overlap": float(overlap),
+                         "within_tolerance": bool(cosine.min() >= COSINE_TOLERANCE
+                                                  and overlap >= NEIGHBOUR_OVERLAP_TOLERANCE)}
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export or benchmark the ONNX Runtime backend.")
+    parser.add_argument("command", choices=["export", "benchmark"])
+    parser.add_argument("model", choices=["classifier", "encoder"])
+    parser.add_argument("--file", default="tmp/1973_T_9.txt")
+    parser.add_argument("--batch-size", type=int, default=32)
+    args = parser.parse_args()
+    if args.command == "export":
+        print(f"Exported to {export_classifier() if args.model == 'classifier' else export_sentence_encoder()}")
+    elif args.model == "classifier":
+        print(json.dumps(benchmark_classifier(args.file, args.batch_size), indent=2))
+    else:
+        print(json.dumps(benchmark_encoder(args.file, batch_size=args.batch_size), indent=2))
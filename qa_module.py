@@ -52,21 +52,46 @@
 
 import os
 import shutil
+import threading
 from legal_processor import LegalDocumentProcessor, RAGApplication
+from answer_cache import AnswerCache
 
 # Update the folder path to match your app.py UPLOAD_FOLDER.
 UPLOAD_FOLDER = "tmp"
 VECTOR_DB_FOLDER = "legal_db"
+BM25_INDEX_FOLDER = "legal_bm25"
 
-# Clean up vector DB folder if it exists (for a new session) and create UPLOAD_FOLDER if not present.
-if os.path.exists(VECTOR_DB_FOLDER):
-    shutil.rmtree(VECTOR_DB_FOLDER)
+# Clean up vector DB and BM25 index folders if they exist (for a new session) and create UPLOAD_FOLDER if not present.
+# Set CASESAGE_RESET_QA_STORE=0 to keep stores filled by the bulk ingestion CLI (ingest.py).
+if os.environ.get("CASESAGE_RESET_QA_STORE", "1") != "0":
+    for folder in (VECTOR_DB_FOLDER, BM25_INDEX_FOLDER):
+        if os.path.exists(folder):
+            shutil.rmtree(folder)
 if not os.path.exists(UPLOAD_FOLDER):
     os.makedirs(UPLOAD_FOLDER)
 
 # Create a global instance of LegalDocumentProcessor using the new folder.
 processor = LegalDocumentProcessor()
 
+# The retriever ensemble, LLM client and RAG chain are built on the first
+# question and reused. Uploads update the processor's vector store and BM25
+# index in place, so the cached retriever sees new documents without a rebuild.
+_rag_app = None
+_rag_lock = threading.Lock()
+
+# Answers are cached per corpus version, so any upload that changes the
+# corpus makes earlier answers unreachable.
+answer_cache = AnswerCache(max_entries=int(os.environ.get("CASESAGE_ANSWER_CACHE_SIZE", 1024)),
+                           ttl=int(os.environ.get("CASESAGE_ANSWER_CACHE_TTL", 3600)),
+                           persist_path=os.environ.get("CASESAGE_ANSWER_CACHE_PATH"))
+
+def get_rag_application():
+    global _rag_app
+    with _rag_lock:
+        if _rag_app is None:
+            _rag_app = RAGApplication(processor.setup_retrievers())
+        return _rag_app
+
 def qa_upload_file(file_obj):
     """
     Saves the uploaded file to UPLOAD_FOLDER and indexes it in the vector database.
@@ -84,9 +109,13 @@ def qa_upload_file(file_obj):
     #     shutil.copyfileobj(file_obj, f)
     
     # Index the file in the vector database.
-    processor.store_in_chroma([save_path])
+    report = processor.store_in_chroma([save_path])
+    if report["failed"]:
+        return None, f"Could not process {save_path}: {report['failed_files'][os.path.normpath(save_path)]}"
     print("File uploaded and processed successfully.")
-    return save_path
+    return save_path, (f"File successfully uploaded and processed at {save_path}: "
+                       f"{report['embedded']} chunk(s) embedded, {report['skipped']} already stored, "
+                       f"{report['deleted']} stale chunk(s) removed.")
 
 def qa_answer_question(question):
     """
@@ -98,7 +127,32 @@ def qa_answer_question(question):
     # if not question:
     #     return "Please input a valid question."
     
-    retriever = processor.setup_retrievers()
-    rag_app = RAGApplication(retriever)
+    rag_app = get_rag_application()
+    corpus_version = processor.corpus_version()
+    cached = answer_cache.get(corpus_version, question)
+    if cached is not None:
+        return cached[1]
     doc_texts, final_answer = rag_app.run(question)
-    return final_answer
\ No newline at end of file
+    answer_cache.put(corpus_version, question, doc_texts, final_answer)
+    return final_answer
+
+def qa_stream_answer(question):
+    """
+    Streams the answer to a question: yields ("sources", doc_texts) first and
+    then ("token", text) pieces as the model generates them.
+    """
+    rag_app = get_rag_application()
+    corpus_version = processor.corpus_version()
+    cached = answer_cache.get(corpus_version, question)
+    if cached is not None:
+        yield "sources", cached[0]
+        yield "token", cached[1]
+        return
+    doc_texts, pieces = [], []
+    for event, data in rag_app.stream(question):
+        if event == "sources":
+            doc_texts = data
+        else:
+            pieces.append(data)
+        yield event, data
+    answer_cache.put(corpus_version, question, doc_texts, "".join(pieces).strip())
\ No newline at end of file
@@ -0,0 +1,143 @@
+import os
+import json
+import argparse
+import numpy as np
+
+QUANTIZATION_KINDS = ("int8", "binary")
+
+# Number of set bits in every byte value, for Hamming distances on packed codes.
+_POPCOUNT = np.array([bin(value).count("1") for value in range(256)], dtype=np.uint8)
+
+
+class QuantizedVectors:
+    """
+    Compressed copy of an embedding matrix used to pick candidates cheaply.
+
+      - "int8": each row scaled by its max absolute value into int8 (4x smaller
+        than float32); scores are the float query dotted with the codes.
+      - "binary": the sign of every dimension packed into bits (32x smaller);
+        scores are the negated Hamming distance to the binarised query.
+
+    Candidates are meant to be rescored against the float vectors.
+    """
+
+    def __init__(self, kind, codes, scales=None):
+        self.kind = kind
+        self.codes = codes
+        self.scales = scales
+
+    @classmethod
+    def from_matrix(cls, kind, matrix):
+        matrix = np.asarray(matrix, dtype=np.float32)
+        if kind == "int8":
+            scales = np.maximum(np.abs(matrix).max(axis=1), 1e-12) / 127
+            codes = np.round(matrix / scales[:, None]).astype(np.int8)
+            return cls(kind, codes, scales.astype(np.float32))
+        if kind == "binary":
+            return cls(kind, np.packbits(matrix > 0, axis=1))
+        raise ValueError(f"Unknown quantization kind '{kind}'")
+
+    def __len__(self):
+        return len(self.codes)
+
+    @property
+    def nbytes(self):
+        return self.codes.nbytes + (self.scales.nbytes if self.scales is not None else 0)
+
+    def append(self, other):
+        codes = np.concatenate([self.codes, other.codes])
+        scales = np.concatenate([self.scales, other.scales]) if self.scales is not None else None
+        return QuantizedVectors(self.kind, codes, scales)
+
+    def scores(self, queries, block_size=65536):
+        """
+        Approximate (queries, rows) similarity scores.
+        """
+        queries = np.asarray(queries, dtype=np.float32)
+        scores = np.empty((len(queries), len(self.codes)), dtype=np.float32)
+        if self.kind == "binary":
+            packed = np.packbits(queries > 0, axis=1)
+        for start in range(0, len(self.codes), block_size):
+            block = np.asarray(self.codes[start:start + block_size])
+            if self.kind == "int8":
+                scale = np.asarray(self.scales[start:start + block_size])
+                scores[:, start:start + block_size] = (queries @ block.T.astype(np.float32)) * scale
+            else:
+                for qi, code in enumerate(packed):
+                    distances = _POPCOUNT[np.bitwise_xor(block, code)].sum(axis=1, dtype=np.int32)
+                    scores[qi, start:start + block_size] = -distances
+        return scores
+
+    def save(self, directory):
+        np.save(os.path.join(directory, f"embeddings.{self.kind}.npy"), self.codes)
+        if self.scales is not None:
+            np.save(os.path.join(directory, f"embeddings.{self.kind}.scales.npy"), self.scales)
+
+    @classmethod
+    def load(cls, directory, kind, mmap_mode="r"):
+        path = os.path.join(directory, f"embeddings.{kind}.npy")
+        if not os.path.exists(path):
+            return None
+        codes = np.load(path, mmap_mode=mmap_mode)
+        scales_path = os.path.join(directory, f"embeddings.{kind}.scales.npy")
+        scales = np.load(scales_path, mmap_mode=mmap_mode) if os.path.exists(scales_path) else None
+        return cls(kind, codes, scales)
+
+
+def top_candidates(scores, n):
+    n = min(n, scores.shape[1])
+    return np.argpartition(-scores, n - 1, axis=1)[:, :n]
+
+
+def benchmark_matrix(matrix, kinds=QUANTIZATION_KINDS, k=10, rescore_factors=(1, 4, 10), num_queries=200):
+    """
+    Reports memory and recall@k of each quantization kind against exact float
+    search over `matrix`, using sampled rows as queries and rescoring the
+    top k * factor candidates in float.
+    """
+    matrix = np.asarray(matrix, dtype=np.float32)
+    matrix = matrix / np.maximum(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-12)
+    sample = np.random.default_rng(0).choice(len(matrix), min(num_queries, len(matrix)), replace=False)
+    queries = matrix[sample]
+    exact = top_candidates(queries @ matrix.T, k)
+    results = {"float32": {"bytes": matrix.nbytes, "recall": 1.0},
+               "float16": {"bytes": matrix.astype(np.float16).nbytes, "recall": 1.0}}
+    for kind in kinds:
+        quantized = QuantizedVectors.from_matrix(kind, matrix)
+        approx = quantized.scores(queries)
+        result = {"bytes": quantized.nbytes, "savings_vs_float32": 1 - quantized.nbytes / matrix.nbytes}
+        for factor in rescore_factors:
+            candidates = top_candidates(approx, k * factor)
+            rescored = np.einsum("qd,qcd->qc", queries, matrix[candidates])
+            found = np.take_along_axis(candidates, top_candidates(rescored, k), axis=1)
+            recall = np.mean([len(set(f) & set(e)) / len(e) for f, e in zip(found, exact)])
+            result[f"recall_rescore_x{factor}"] = float(recall)
+        results[kind] = result
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build or benchmark quantized embedding copies.")
+    parser.add_argument("command", choices=["build", "benchmark"])
+    parser.add_argument("--store", default="similarity_store", help="similarity store directory")
+    parser.add_argument("--chroma", default=None,
+                        help="benchmark the QA chunk vectors in this Chroma directory instead of the store")
+    parser.add_argument("--kind", choices=QUANTIZATION_KINDS, default="int8")
+    parser.add_argument("--k", type=int, default=10)
+    args = parser.parse_args()
+
+    if args.command == "build":
+        from similarity_store import SimilarityStore, save_quantized
+        store = SimilarityStore(args.store, use_ann=False, quantization=None)
+        save_quantized(args.store, QuantizedVectors.from_matrix(args.kind, store.embeddings), store.manifest)
+        print(f"Wrote {args.kind} copy of {len(store.embeddings)} embeddings to {args.store}")
+    else:
+        if args.chroma:
+            from legal_processor import LegalDocumentProcessor
+            processor = LegalDocumentProcessor()
+            processor.vector_store_directory = args.chroma
+            matrix = processor.get_vector_store().get(include=["embeddings"])["embeddings"]
+        else:
+            from similarity_store import SimilarityStore
+            matrix = SimilarityStore(args.store, use_ann=False, quantization=None).embeddings
+        print(json.dumps(benchmark_matrix(matrix, k=args.k), indent=2))
@@ -1,17 +1,40 @@
+import os
 import json
-import uuid
 import re
+import time
+import threading
+import argparse
+from concurrent.futures import ProcessPoolExecutor
 import torch
 import numpy as np
 from transformers import (AutoTokenizer,
                           AutoModelForSequenceClassification,
-                          BatchEncoding,
-                          TrainingArguments,
-                          Trainer)
-from datasets import Dataset
-from data_preprocessing import rearrange_df  # Make sure this module is available
+                          BatchEncoding)
+from data_preprocessing import WordIndex, get_context  # Make sure this module is available
+from model_registry import model_revision, registry
+from legal_segmenter import Span, segment_sentences
+from label_cache import LabelCache, label_key
+from onnx_backend import ONNX_DIRECTORY, OnnxSequenceClassifier, backend_model_path, load_backend
 
 MAX_SEQUENCE_LENGTH = 512
+# Sentences per forward pass and intra-op CPU threads for the role classifier.
+CLASSIFIER_BATCH_SIZE = int(os.environ.get("CASESAGE_CLASSIFIER_BATCH_SIZE", 32))
+CLASSIFIER_THREADS = int(os.environ.get("CASESAGE_CLASSIFIER_THREADS", 0))
+# Sentences featurized and classified at a time, which bounds memory on very long judgments.
+CLASSIFIER_CHUNK_SENTENCES = int(os.environ.get("CASESAGE_CLASSIFIER_CHUNK_SENTENCES", 512))
+# Worker processes segmenting documents for label_documents(); 0 means one per CPU.
+SEGMENT_WORKERS = int(os.environ.get("CASESAGE_SEGMENT_WORKERS", 0))
+
+ID2LABEL = {0: 'PREAMBLE', 1: 'NONE', 2: 'FAC', 3: 'ARG_RESPONDENT', 4: 'RLC',
+            5: 'ARG_PETITIONER', 6: 'ANALYSIS', 7: 'PRE_RELIED', 8: 'RATIO',
+            9: 'RPC', 10: 'ISSUE', 11: 'STA', 12: 'PRE_NOT_RELIED'}
+
+# Labels of recurring sentences (citations, bench listings, standard recitals), shared by all requests.
+label_cache = LabelCache(max_entries=int(os.environ.get("CASESAGE_LABEL_CACHE_SIZE", 100000)),
+                         persist_path=os.environ.get("CASESAGE_LABEL_CACHE_PATH"))
+
+# Fast tokenizers are not safe to call from several threads at once.
+_tokenizer_lock = threading.Lock()
 
 def preprocess_function(batch, tokenizer: AutoTokenizer, context: bool) -> BatchEncoding:
     if context:
@@ -27,71 +50,195 @@ def preprocess_function(batch, tokenizer: AutoTokenizer, context: bool) -> Batch
                            max_length=MAX_SEQUENCE_LENGTH)
     return inputs
 
-def generate_json_from_doc(text):
-    d = {"id": 1, "annotations": [{"result": []}], "data": {'text': text}}
-    t = ""
-    start = 0
-    end = 0
-    for i in range(len(text)):
-        if text[i] != '.' or ((i - start) < 30):
-            t += "'" if text[i] == "`" else text[i]
-            continue
-        end = i
-        if len(t) > 0:
-            l = {"id": str(uuid.uuid1()),
-                 "value": {"start": start, "end": end, "text": t, "labels": [""]}}
-            d["annotations"][0]["result"].append(l)
-        t = ""
-        start = i + 1
-    return json.dumps(d)
-
-def infer(filepath):
-    # Read the document and generate a temporary JSON file
-    with open(filepath, "r", encoding="utf-8") as f:
-        text = f.read()
-    temp_json = generate_json_from_doc(text)
-    temp_json_path = "./judgement.json"
-    with open(temp_json_path, "w", encoding="utf-8") as jsonfile:
-        jsonfile.write(temp_json)
-    
+def iter_sentences(text):
+    """
+    Yields a Span for each sentence found by the legal segmenter. The span
+    excludes the closing full stop, which generate_html adds.
+    """
+    for span in segment_sentences(text):
+        end = span.end - 1 if text[span.end - 1] == '.' else span.end
+        if end > span.start:
+            yield Span(span.start, end)
+
+def sentence_text(span, text):
+    return span.text(text).replace("`", "'")
+
+def load_role_classifier(backend="torch"):
     # Load the saved model and tokenizer
-    model = AutoModelForSequenceClassification.from_pretrained("./saved_model/")
     tokenizer = AutoTokenizer.from_pretrained("./saved_tokenizer/")
-    
+    if CLASSIFIER_THREADS:
+        torch.set_num_threads(CLASSIFIER_THREADS)
+
+    def load_torch_model():
+        model = AutoModelForSequenceClassification.from_pretrained("./saved_model/")
+        model.eval()
+        return model
+
+    model = load_backend(backend, os.path.join(ONNX_DIRECTORY, "role_classifier"), OnnxSequenceClassifier,
+                         load_torch_model)
+    return model, tokenizer
+
+# CASESAGE_CLASSIFIER_BACKEND=onnx runs the int8 model exported with `python onnx_backend.py export classifier`.
+registry.register("role_classifier",
+                  lambda: load_role_classifier(os.environ.get("CASESAGE_CLASSIFIER_BACKEND", "torch")))
+
+def predict_logits(model, tokenizer, sentences, contexts=None, batch_size=CLASSIFIER_BATCH_SIZE):
+    """
+    Returns the (sentences, labels) logits of the classifier, a PyTorch
+    model or an OnnxSequenceClassifier.
+
+    Inputs are tokenized once without padding, sorted by length and run in
+    batches padded only to the longest input of the batch, so short
+    sentences no longer cost a full MAX_SEQUENCE_LENGTH forward pass.
+    """
+    with _tokenizer_lock:
+        if contexts is None:
+            encodings = tokenizer(list(sentences), truncation=True, max_length=MAX_SEQUENCE_LENGTH)
+        else:
+            encodings = tokenizer(list(sentences), list(contexts), truncation=True, max_length=MAX_SEQUENCE_LENGTH)
+    order = np.argsort([len(ids) for ids in encodings["input_ids"]], kind="stable")
+    onnx = isinstance(model, OnnxSequenceClassifier)
+    logits = np.zeros((len(order), model.num_labels if onnx else model.config.num_labels), dtype=np.float32)
+    device = None if onnx else next(model.parameters()).device
+    with torch.inference_mode():
+        for start in range(0, len(order), batch_size):
+            rows = order[start:start + batch_size]
+            batch = tokenizer.pad([{key: encodings[key][row] for key in encodings.keys()} for row in rows],
+                                  return_tensors="np" if onnx else "pt")
+            if onnx:
+                logits[rows] = model.predict(batch)
+                continue
+            batch = {key: value.to(device) for key, value in batch.items()}
+            logits[rows] = model(**batch).logits.float().cpu().numpy()
+    return logits
+
+def trainer_predict_logits(model, tokenizer, sentences, contexts):
+    """
+    The previous Trainer.predict path (max_length padding), kept for benchmark().
+    """
+    from datasets import Dataset
+    from transformers import TrainingArguments, Trainer
     training_args = TrainingArguments(report_to="none", output_dir="./inf_output/")
     trainer = Trainer(model=model, tokenizer=tokenizer, args=training_args)
-    
-    # Load and preprocess the generated JSON data
-    with open(temp_json_path, "r", encoding="utf-8") as jsonfile:
-        data = json.load(jsonfile)
-    data_df = rearrange_df([data], max_len_context=MAX_SEQUENCE_LENGTH)
-    dataset = Dataset.from_pandas(data_df.copy())
+    dataset = Dataset.from_dict({'sentence': list(sentences), 'context': list(contexts)})
     dataset_data = dataset.map(
         preprocess_function,
         fn_kwargs={'tokenizer': tokenizer, 'context': True},
         batched=True,
         remove_columns=dataset.column_names
     )
-    
     logits, _, _ = trainer.predict(dataset_data)
-    # Map model output to label names
-    id2label = {0: 'PREAMBLE', 1: 'NONE', 2: 'FAC', 3: 'ARG_RESPONDENT', 4: 'RLC',
-                5: 'ARG_PETITIONER', 6: 'ANALYSIS', 7: 'PRE_RELIED', 8: 'RATIO',
-                9: 'RPC', 10: 'ISSUE', 11: 'STA', 12: 'PRE_NOT_RELIED'}
-    predictions = [np.argmax(pred) for pred in logits]
-    
-    # Assume data_df has a 'doc_id' and 'sentence' column
-    data_df.reset_index(inplace=True)
-    doc = data_df[data_df['doc_id'] == 1]
-    outputs = []
-    for s in range(len(doc)):
-        idx = doc.index[s]
-        label = id2label[predictions[idx]]
-        # Use regex to extract words from the sentence
-        sentence_words = re.findall(r'\S+', doc.iloc[idx]['sentence'])
-        sentence_text = ' '.join(sentence_words)
-        outputs.append((label, sentence_text))
-    return outputs
+    return logits
+
+def iter_features(text, max_len=MAX_SEQUENCE_LENGTH):
+    """
+    Yields (start, end, sentence, context) for each distinct sentence of the document.
+    """
+    index = WordIndex(text)
+    seen = set()
+    for span in iter_sentences(text):
+        sentence = sentence_text(span, text)
+        if sentence in seen:
+            continue
+        seen.add(sentence)
+        yield span.start, span.end, sentence, get_context(text, sentence, span.start, span.end, max_len, index)
+
+def _document_features(text):
+    # Runs in a segmentation worker process.
+    return list(iter_features(text))
+
+def classifier_version(model):
+    """
+    Identifies the loaded classifier weights, so cached labels are not
+    reused after the model is retrained or the backend changes.
+    """
+    return model_revision(model.model_path if isinstance(model, OnnxSequenceClassifier) else "./saved_model/")
+
+def role_classifier_path():
+    """
+    The model file or directory the role_classifier registry entry loads
+    for CASESAGE_CLASSIFIER_BACKEND, so callers can key caches on it
+    without loading the model.
+    """
+    return backend_model_path(os.environ.get("CASESAGE_CLASSIFIER_BACKEND", "torch"),
+                              os.path.join(ONNX_DIRECTORY, "role_classifier"), "./saved_model/")
+
+def label_features(features, model, tokenizer, version):
+    """
+    Returns (labels, classified): the label of each (start, end, sentence,
+    context) feature and how many of them were classified. Labels are looked
+    up in label_cache first; only misses are classified, together in one
+    predict_logits() call.
+    """
+    keys = [label_key(version, sentence, context) for _, _, sentence, context in features]
+    labels = label_cache.get_many(keys)
+    misses = [i for i, label in enumerate(labels) if label is None]
+    if misses:
+        logits = predict_logits(model, tokenizer, [features[i][2] for i in misses], [features[i][3] for i in misses])
+        for i, prediction in zip(misses, np.argmax(logits, axis=1)):
+            labels[i] = ID2LABEL[int(prediction)]
+        label_cache.put_many([keys[i] for i in misses], [labels[i] for i in misses])
+    return labels, len(misses)
+
+def label_documents(documents, workers=None, chunk_sentences=CLASSIFIER_CHUNK_SENTENCES):
+    """
+    Labels many judgments in one call. `documents` is a list of
+    (doc_id, text) pairs.
+
+    Documents are segmented in parallel worker processes and the sentences
+    of all documents are packed into shared inference batches of
+    `chunk_sentences`. A single document (or workers=1) is featurized
+    lazily in this process, so at most one batch of features is in memory
+    however long the judgment is. Returns
+    {"documents": [{"doc_id", "sentences": [{"start", "end", "label", "text"}]}],
+     "stats": {"documents", "sentences", "classified", "seconds", "documents_per_min"}}
+    where start/end are character offsets into the document's text.
+    """
+    started = time.perf_counter()
+    workers = workers or SEGMENT_WORKERS or os.cpu_count() or 1
+    texts = [text for _, text in documents]
+    model, tokenizer = registry.get("role_classifier")
+    version = classifier_version(model)
+    results = [{"doc_id": doc_id, "sentences": []} for doc_id, _ in documents]
+    pending = []
+    classified = 0
+
+    def flush():
+        nonlocal classified
+        labels, misses = label_features([feature for _, feature in pending], model, tokenizer, version)
+        classified += misses
+        for (doc_index, (start, end, sentence, _)), label in zip(pending, labels):
+            results[doc_index]["sentences"].append({"start": start, "end": end, "label": label,
+                                                    "text": ' '.join(re.findall(r'\S+', sentence))})
+        pending.clear()
+
+    executor = ProcessPoolExecutor(max_workers=min(workers, len(documents))) \
+        if workers > 1 and len(documents) > 1 else None
+    try:
+        # Documents come back in order as workers finish them; full batches are classified meanwhile.
+        features = executor.map(_document_features, texts) if executor else map(iter_features, texts)
+        for doc_index, doc_features in enumerate(features):
+            for feature in doc_features:
+                pending.append((doc_index, feature))
+                if len(pending) >= chunk_sentences:
+                    flush()
+        if pending:
+            flush()
+    finally:
+        if executor:
+            executor.shutdown()
+
+    seconds = time.perf_counter() - started
+    stats = {"documents": len(documents), "sentences": sum(len(result["sentences"]) for result in results),
+             "classified": classified, "seconds": seconds,
+             "documents_per_min": 60 * len(documents) / seconds if seconds else 0.0}
+    return {"documents": results, "stats": stats}
+
+def render_html(document):
+    """
+    Renders one document of label_documents() output as highlighted HTML.
+    """
+    return "".join(generate_html(sentence["text"], sentence["label"]) + "<br>" for sentence in document["sentences"])
 
 def generate_html(text, label):
     label_colour_mapping = {
@@ -112,3 +259,48 @@ def generate_html(text, label):
     # Replace newline characters with HTML line breaks
     text = text.replace("\n", "<br>")
     return f'<span title="{label_text_mapping[label]}" class="highlight" style="background-color:{label_colour_mapping[label]}">{text}.</span>'
+
+def benchmark(filepath="tmp/1973_T_9.txt", batch_sizes=(8, 16, 32, 64)):
+    """
+    Compares sentences/sec of the Trainer.predict path with predict_logits()
+    at several batch sizes on one judgment, and checks both give the same labels.
+    """
+    with open(filepath, "r", encoding="utf-8") as f:
+        features = list(iter_features(f.read()))
+    sentences = [sentence for _, _, sentence, _ in features]
+    contexts = [context for _, _, _, context in features]
+    model, tokenizer = registry.get("role_classifier")
+
+    start = time.perf_counter()
+    reference = np.argmax(trainer_predict_logits(model, tokenizer, sentences, contexts), axis=1)
+    seconds = time.perf_counter() - start
+    results = {"sentences": len(sentences),
+               "trainer_predict": {"seconds": seconds, "sentences_per_sec": len(sentences) / seconds}}
+    for batch_size in batch_sizes:
+        start = time.perf_counter()
+        logits = predict_logits(model, tokenizer, sentences, contexts, batch_size=batch_size)
+        seconds = time.perf_counter() - start
+        results[f"dynamic_batch_{batch_size}"] = {"seconds": seconds, "sentences_per_sec": len(sentences) / seconds,
+                                                  "label_agreement": float(np.mean(np.argmax(logits, axis=1) == reference))}
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark rhetorical-role inference throughput.")
+    parser.add_argument("--file", default="tmp/1973_T_9.txt")
+    parser.add_argument("--batch-sizes", default="8,16,32,64")
+    parser.add_argument("--label", nargs="+", metavar="FILE",
+                        help="label these judgments with label_documents() and report documents/min instead")
+    parser.add_argument("--out", help="write the labelled spans of --label to this JSON file")
+    args = parser.parse_args()
+    if args.label:
+        documents = []
+        for path in args.label:
+            with open(path, "r", encoding="utf-8") as f:
+                documents.append((os.path.basename(path), f.read()))
+        result = label_documents(documents)
+        if args.out:
+            with open(args.out, "w", encoding="utf-8") as f:
+                json.dump(result, f)
+        print(json.dumps(result["stats"], indent=2))
+    else:
+        print(json.dumps(benchmark(args.file, [int(size) for size in args.batch_sizes.split(",")]), indent=2))
@@ -1,25 +1,49 @@
 import os
-import glob
 import torch
-from pypdf import PdfReader
-from sentence_transformers import SentenceTransformer, util
+from sentence_transformers import SentenceTransformer
 from transformers import BartForConditionalGeneration, BartTokenizer
+from model_registry import registry
+from onnx_backend import ONNX_DIRECTORY, OnnxSentenceEncoder, load_backend
+from similarity_store import SimilarityStore
+from chunked_encoding import ChunkedEncoder, search as search_similar, search_batch
+
+# CASESAGE_SIMILARITY_BACKEND=onnx runs the int8 model exported with `python onnx_backend.py export encoder`.
+registry.register("similarity_encoder",
+                  lambda: load_backend(os.environ.get("CASESAGE_SIMILARITY_BACKEND", "torch"),
+                                       os.path.join(ONNX_DIRECTORY, "similarity_encoder"), OnnxSentenceEncoder,
+                                       lambda: SentenceTransformer("fine_tuned_similarity_model_ver2.0")))
+# Memory-mapped embeddings and corpus, built with `python similarity_store.py`.
+# CASESAGE_SIMILARITY_QUANTIZATION=int8|binary scans a quantized copy and rescores in float.
+registry.register("similarity_store",
+                  lambda: SimilarityStore(quantization=os.environ.get("CASESAGE_SIMILARITY_QUANTIZATION")))
+
+def batch_similarity(documents, k=5, batch_size=32):
+    """
+    Finds the top k similar judgments for many query documents at once.
+    `documents` is a list of (query_id, text) pairs. The texts are encoded in
+    batches and scored against the corpus together. Returns a list of
+    {"query": query_id, "matches": [{"doc_id", "filename", "score"}, ...]}.
+    """
+    store = registry.get("similarity_store")
+    encoder = ChunkedEncoder(registry.get("similarity_encoder"), pooling=store.pooling)
+    results = []
+    hits = search_batch(store, encoder, [text for _, text in documents], k=k, batch_size=batch_size)
+    for (query_id, _), (scores, rows) in zip(documents, hits):
+        matches = [{"doc_id": store.manifest["rows"][row]["doc_id"], "filename": store.names[row],
+                    "score": float(score)} for score, row in zip(scores, rows)]
+        results.append({"query": query_id, "matches": matches})
+    return results
 
 def compute_similarity(filepath):
+    from utils import extract_pdf_text
     output_html = ""
     
     # ---- Extract text from PDF using PyPDF ----
     try:
-        reader = PdfReader(filepath)
+        query_text = extract_pdf_text(filepath)
     except Exception as e:
         return f"<p>Error reading PDF: {e}</p>"
     
-    query_text = ""
-    for page in reader.pages:
-        text = page.extract_text()
-        if text:
-            query_text += text + " "
-    
     if not query_text.strip():
         return "<p>Error: No text could be extracted from the uploaded document.</p>"
     
@@ -27,50 +51,20 @@ def compute_similarity(filepath):
     preview = query_text[:500] + ("..." if len(query_text) > 500 else "")
     output_html += f"<h3>Extracted Text (Preview)</h3><p>{preview}</p>"
     
-    # ---- Load the Fine-Tuned Similarity Model ----
-    output_html += "<p>Loading similarity model...</p>"
-    similarity_model = SentenceTransformer("fine_tuned_similarity_model_ver2.0")
-    query_embedding = similarity_model.encode(query_text, convert_to_tensor=True)
-    
-    # ---- Load Dataset Documents ----
-    output_html += "<p>Loading dataset documents...</p>"
-    dataset_path = "data"
-    doc_files = sorted(glob.glob(os.path.join(dataset_path, "*.txt")))
-    if not doc_files:
-        return "<p>Error: No documents found in the dataset folder.</p>"
-    
-    doc_texts = []
-    doc_names = []
-    for file in doc_files:
-        # try:
-        with open(file, "r") as f:
-            text = f.read()
-            doc_texts.append(text)
-            doc_names.append(os.path.basename(file))
-        # except Exception as e:
-        #     output_html += f"<p>Warning: Could not read {file}: {e}</p>"
-    
-    if not doc_texts:
-        return "<p>Error: No readable documents were loaded from the dataset.</p>"
-    
-    # ---- Load Precomputed Embeddings ----
-    output_html += "<p>Loading precomputed document embeddings...</p>"
+    # ---- Score against the memory-mapped corpus ----
     try:
-        loaded_obj = torch.load("document_embeddings_text+entity.pt")
+        store = registry.get("similarity_store")
     except Exception as e:
-        return f"<p>Error loading embeddings: {e}</p>"
+        return f"<p>Error loading similarity corpus: {e}</p>"
     
-    if isinstance(loaded_obj, dict):
-        if "embeddings" in loaded_obj:
-            doc_embeddings = loaded_obj["embeddings"]
-        else:
-            return f"<p>Error: Embeddings file is a dict but does not contain key 'embeddings'. Found keys: {', '.join(loaded_obj.keys())}</p>"
-    else:
-        doc_embeddings = loaded_obj
-
-    # ---- Compute Similarity Scores ----
-    cosine_scores = util.cos_sim(query_embedding, doc_embeddings)[0]
-    top_results = torch.topk(cosine_scores, k=5)
+    if len(store) == 0:
+        return "<p>Error: No documents found in the similarity corpus.</p>"
+    
+    # The query is encoded the same way as the corpus (whole-text, or windows
+    # encoded in one batch and pooled), so long judgments are not truncated.
+    similarity_model = registry.get("similarity_encoder")
+    encoder = ChunkedEncoder(similarity_model, pooling=store.pooling)
+    top_scores, top_rows = search_similar(store, encoder, query_text, k=5)
 
     output_html += '<h2 class="subheader">Top 5 Similar Documents</h2>'
     
@@ -81,10 +75,11 @@ def compute_similarity(filepath):
     # bart_model = BartForConditionalGeneration.from_pretrained(bart_model_name)
     
     # ---- Loop over the top similar documents and build HTML output ----
-    for score, idx in zip(top_results[0], top_results[1]):
-        doc_name = doc_names[idx]
-        sim_score = score.item()
-        doc_text = doc_texts[idx]
+    for score, idx in zip(top_scores, top_rows):
+        doc_name = store.names[idx]
+        sim_score = float(score)
+        # Only the rendered documents' texts are read from disk.
+        doc_text = store.read_text(idx, max_chars=300)
         
         # # Summarize the document using BART
         # input_ids = bart_tokenizer.encode(doc_text, truncation=True, max_length=1024, return_tensors="pt")
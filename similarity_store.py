@@ -0,0 +1,437 @@
+import os
+import glob
+import json
+import hashlib
+import logging
+import argparse
+import numpy as np
+from chunked_encoding import POOLING_STRATEGIES, ChunkedEncoder, pool
+from quantization import QUANTIZATION_KINDS, QuantizedVectors
+
+STORE_DIRECTORY = "similarity_store"
+
+
+class SimilarityStore:
+    """
+    Memory-mapped corpus for judgment similarity.
+
+    The directory holds:
+      - embeddings.npy: L2-normalised float16 document embeddings, one row per document
+      - corpus.txt: every document's text concatenated (UTF-8)
+      - offsets.npy: int64 byte offsets of each document in corpus.txt (n + 1 entries)
+      - manifest.json: doc ID, file name, content hash and deleted flag of every row,
+        plus how documents were encoded ("pooling", see chunked_encoding.py)
+      - passages.npy / passage_offsets.npy: per-window embeddings of each document
+        and the row -> window offsets (only for "maxsim" pooling)
+      - optional derived files, checked against manifest_hash() when loaded: the ANN
+        index (ann.*, ann_meta.json) and int8 / binary copies of the embeddings
+        (embeddings.<kind>.npy, .scales.npy and .json)
+
+    The manifest is the source of truth for the number of rows: rows past its
+    end (left by an interrupted update) are ignored, and deleted rows are
+    never returned.
+
+    Arrays are opened with mmap_mode="r", so the pages are shared by every
+    worker process through the OS page cache and only the rows and texts that
+    are actually touched are read from disk.
+    """
+
+    def __init__(self, directory=STORE_DIRECTORY, use_ann=True, rescore_factor=4, ann_params=None,
+                 quantization=None):
+        self.directory = directory
+        self.manifest = load_manifest(directory)
+        rows = self.manifest["rows"]
+        self.embeddings = np.load(os.path.join(directory, "embeddings.npy"), mmap_mode="r")[:len(rows)]
+        self.offsets = np.load(os.path.join(directory, "offsets.npy"), mmap_mode="r")[:len(rows) + 1]
+        self.names = [row["filename"] for row in rows]
+        self.alive = np.array([not row["deleted"] for row in rows], dtype=bool)
+        self.corpus_path = os.path.join(directory, "corpus.txt")
+        self.pooling = self.manifest.get("pooling", "truncate")
+        if self.pooling == "maxsim":
+            self.passage_offsets = np.load(os.path.join(directory, "passage_offsets.npy"),
+                                           mmap_mode="r")[:len(rows) + 1]
+            self.passages = np.load(os.path.join(directory, "passages.npy"),
+                                    mmap_mode="r")[:int(self.passage_offsets[-1])]
+        # Identifies the embeddings derived files (ANN index, quantized copies) were built from.
+        self.manifest_hash = manifest_hash(self.manifest)
+        # Optional ANN index built offline with `python ann_index.py build`.
+        self.rescore_factor = rescore_factor
+        self.ann = None
+        if use_ann:
+            from ann_index import load_ann_index
+            self.ann = load_ann_index(directory, self.embeddings.shape[1], len(rows), self.manifest_hash,
+                                      **(ann_params or {}))
+        # Optional int8 / binary copy built with `python quantization.py build`.
+        self.quantized = None
+        if quantization:
+            quantized = QuantizedVectors.load(directory, quantization)
+            if (quantized is None or len(quantized) < len(rows)
+                    or quantized_manifest_hash(directory, quantization) != self.manifest_hash):
+                logging.warning(f"No up-to-date {quantization} embeddings in {directory}; scanning float16")
+            else:
+                self.quantized = QuantizedVectors(quantization, quantized.codes[:len(rows)],
+                                                  quantized.scales[:len(rows)] if quantized.scales is not None else None)
+
+    def __len__(self):
+        return int(self.alive.sum())
+
+    def read_text(self, row, max_chars=None):
+        start, end = int(self.offsets[row]), int(self.offsets[row + 1])
+        if max_chars is not None:
+            # A UTF-8 character is at most 4 bytes.
+            end = min(end, start + 4 * max_chars)
+        with open(self.corpus_path, "rb") as f:
+            f.seek(start)
+            text = f.read(end - start).decode("utf-8", errors="ignore")
+        return text[:max_chars] if max_chars is not None else text
+
+    def top_k(self, query_embedding, k=5, exact=False, rescore_factor=None, block_size=65536):
+        """
+        Returns (scores, rows) of the k documents most cosine-similar to the
+        query.
+
+        With an ANN index (and exact=False) the index proposes
+        k * rescore_factor candidates which are rescored exactly against the
+        stored embeddings; rescore_factor=0 returns the ANN scores as they are.
+        Otherwise the float16 matrix is scanned, upcast one block at a time, so
+        memory stays bounded regardless of corpus size.
+        """
+        query = np.asarray(query_embedding, dtype=np.float32).ravel()
+        query = query / max(float(np.linalg.norm(query)), 1e-12)
+        rescore_factor = self.rescore_factor if rescore_factor is None else rescore_factor
+        if self.ann is not None and not exact:
+            return self._ann_top_k(query, k, rescore_factor)
+        if self.quantized is not None and not exact:
+            return self._quantized_top_k(query, k, max(rescore_factor, 1))
+        scores = np.empty(len(self.embeddings), dtype=np.float32)
+        for start in range(0, len(self.embeddings), block_size):
+            block = np.asarray(self.embeddings[start:start + block_size], dtype=np.float32)
+            scores[start:start + block_size] = block @ query
+        scores[~self.alive] = -np.inf
+        k = min(k, len(self))
+        rows = np.argpartition(-scores, k - 1)[:k]
+        rows = rows[np.argsort(-scores[rows])]
+        return scores[rows], rows
+
+    def top_k_batch(self, query_embeddings, k=5, block_size=65536):
+        """
+        Returns (scores, rows) arrays of shape (queries, k) for a batch of
+        query embeddings, scored with one matrix product per block of the
+        corpus. Only a running top-k per query is kept between blocks, so
+        memory does not grow with corpus size.
+        """
+        queries = np.asarray(query_embeddings, dtype=np.float32)
+        queries = queries / np.maximum(np.linalg.norm(queries, axis=1, keepdims=True), 1e-12)
+        k = min(k, len(self))
+        if self.ann is not None or self.quantized is not None:
+            results = [self.top_k(query, k=k) for query in queries]
+            return np.stack([r[0] for r in results]), np.stack([r[1] for r in results])
+        best_scores = np.full((len(queries), 0), -np.inf, dtype=np.float32)
+        best_rows = np.zeros((len(queries), 0), dtype=np.int64)
+        for start in range(0, len(self.embeddings), block_size):
+            block = np.asarray(self.embeddings[start:start + block_size], dtype=np.float32)
+            scores = queries @ block.T
+            scores[:, ~self.alive[start:start + block_size]] = -np.inf
+            scores = np.concatenate([best_scores, scores], axis=1)
+            rows = np.concatenate([best_rows, np.broadcast_to(np.arange(start, start + len(block)),
+                                                              (len(queries), len(block)))], axis=1)
+            keep = np.argpartition(-scores, min(k, scores.shape[1]) - 1, axis=1)[:, :k]
+            best_scores = np.take_along_axis(scores, keep, axis=1)
+            best_rows = np.take_along_axis(rows, keep, axis=1)
+        order = np.argsort(-best_scores, axis=1)
+        return np.take_along_axis(best_scores, order, axis=1), np.take_along_axis(best_rows, order, axis=1)
+
+    def top_k_maxsim(self, window_vectors, k=5, block_size=65536):
+        """
+        Passage-level max-sim: a document's score is the best cosine between
+        any query window and any of its stored passages.
+        """
+        queries = np.asarray(window_vectors, dtype=np.float32)
+        queries = queries / np.maximum(np.linalg.norm(queries, axis=1, keepdims=True), 1e-12)
+        passage_scores = np.empty(len(self.passages), dtype=np.float32)
+        for start in range(0, len(self.passages), block_size):
+            block = np.asarray(self.passages[start:start + block_size], dtype=np.float32)
+            passage_scores[start:start + block_size] = (block @ queries.T).max(axis=1)
+        # Every document has at least one passage, so no reduceat segment is empty.
+        scores = np.maximum.reduceat(passage_scores, np.asarray(self.passage_offsets[:-1], dtype=np.int64))
+        scores[~self.alive] = -np.inf
+        k = min(k, len(self))
+        rows = np.argpartition(-scores, k - 1)[:k]
+        rows = rows[np.argsort(-scores[rows])]
+        return scores[rows], rows
+
+    def _quantized_top_k(self, query, k, rescore_factor):
+        # Scan the compressed copy, then rescore the best candidates in float.
+        scores = self.quantized.scores(query[None, :])[0]
+        scores[~self.alive] = -np.inf
+        n_candidates = min(k * rescore_factor, len(self))
+        rows = np.sort(np.argpartition(-scores, n_candidates - 1)[:n_candidates])
+        scores = np.asarray(self.embeddings[rows], dtype=np.float32) @ query
+        top = np.argsort(-scores)[:k]
+        return scores[top], rows[top]
+
+    def _ann_top_k(self, query, k, rescore_factor):
+        # Ask for extra candidates to make up for deleted rows still in the index.
+        n_deleted = len(self.alive) - len(self)
+        scores, rows = self.ann.search(query[None, :], min(k * max(rescore_factor, 1) + n_deleted, len(self.alive)))
+        scores, rows = scores[0], rows[0]
+        valid = rows >= 0
+        valid[valid] = self.alive[rows[valid]]
+        scores, rows = scores[valid], rows[valid]
+        if rescore_factor:
+            order = np.argsort(rows)
+            rows = rows[order]
+            scores = np.asarray(self.embeddings[rows], dtype=np.float32) @ query
+        top = np.argsort(-scores)[:k]
+        return scores[top], rows[top]
+
+
+def doc_id_for(filename):
+    return os.path.splitext(os.path.basename(filename))[0]
+
+
+def content_hash(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def load_manifest(directory):
+    with open(os.path.join(directory, "manifest.json"), "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def manifest_hash(manifest):
+    """
+    Hash of the store's pooling and the doc ID and content hash of every
+    row, so an index built from the embeddings can tell when the store was
+    rebuilt or updated since, even with the same number of rows.
+    """
+    sha = hashlib.sha256(manifest.get("pooling", "truncate").encode("utf-8"))
+    for row in manifest["rows"]:
+        sha.update(f"\n{row['doc_id']}:{row['content_hash']}".encode("utf-8"))
+    return sha.hexdigest()
+
+
+def save_quantized(directory, quantized, manifest):
+    """
+    Writes a quantized copy of the store's embeddings, recording the
+    manifest_hash() of the rows it covers.
+    """
+    quantized.save(directory)
+    _save_quantized_meta(directory, quantized.kind, manifest)
+
+
+def _save_quantized_meta(directory, kind, manifest):
+    path = os.path.join(directory, f"embeddings.{kind}.json")
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump({"size": len(manifest["rows"]), "manifest_hash": manifest_hash(manifest)}, f)
+    os.replace(path + ".tmp", path)
+
+
+def quantized_manifest_hash(directory, kind):
+    """
+    The manifest_hash() a quantized copy was built for, or None when unknown.
+    """
+    try:
+        with open(os.path.join(directory, f"embeddings.{kind}.json"), "r", encoding="utf-8") as f:
+            return json.load(f)["manifest_hash"]
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def save_manifest(directory, manifest):
+    path = os.path.join(directory, "manifest.json")
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(manifest, f)
+    os.replace(path + ".tmp", path)
+
+
+def create_empty_store(directory, dim, pooling="truncate"):
+    """
+    Creates an empty store to be filled by update_store with documents
+    encoded using the given pooling strategy.
+    """
+    write_store(directory, [], [], np.zeros((0, dim), dtype=np.float32), pooling=pooling)
+
+
+def write_store(directory, names, texts, embeddings, pooling="truncate"):
+    os.makedirs(directory, exist_ok=True)
+    # An ANN index or quantized copy of the previous contents would otherwise be served for the new rows.
+    for pattern in ("ann.*", "ann_meta.json", "embeddings.*.npy", "embeddings.*.json"):
+        for path in glob.glob(os.path.join(directory, pattern)):
+            os.remove(path)
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    embeddings = embeddings / np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12)
+    np.save(os.path.join(directory, "embeddings.npy"), embeddings.astype(np.float16))
+    if pooling == "maxsim":
+        # Passages are added by update_store, which computes per-window vectors.
+        if len(embeddings):
+            raise ValueError("maxsim stores must be filled with update_store")
+        np.save(os.path.join(directory, "passages.npy"), embeddings.astype(np.float16))
+        np.save(os.path.join(directory, "passage_offsets.npy"), np.zeros(1, dtype=np.int64))
+    offsets = [0]
+    with open(os.path.join(directory, "corpus.txt"), "wb") as f:
+        for text in texts:
+            data = text.encode("utf-8")
+            f.write(data)
+            offsets.append(offsets[-1] + len(data))
+    np.save(os.path.join(directory, "offsets.npy"), np.array(offsets, dtype=np.int64))
+    rows = [{"doc_id": doc_id_for(name), "filename": name, "content_hash": content_hash(text), "deleted": False}
+            for name, text in zip(names, texts)]
+    save_manifest(directory, {"dim": embeddings.shape[1], "pooling": pooling, "rows": rows})
+
+
+def _append_rows(path, new_rows, length):
+    # Grows an .npy file by copying its first `length` rows block by block
+    # into a larger memory-mapped file and writing the new rows after them.
+    old = np.load(path, mmap_mode="r")[:length]
+    new_rows = np.asarray(new_rows, dtype=old.dtype)
+    grown = np.lib.format.open_memmap(path + ".tmp", mode="w+", dtype=old.dtype,
+                                      shape=(length + len(new_rows),) + old.shape[1:])
+    for start in range(0, length, 65536):
+        stop = min(start + 65536, length)
+        grown[start:stop] = old[start:stop]
+    grown[length:] = new_rows
+    grown.flush()
+    del grown, old
+    os.replace(path + ".tmp", path)
+
+
+def update_store(encoder, dataset_path="data", directory=STORE_DIRECTORY, batch_size=32):
+    """
+    Brings the store in line with the dataset folder without rebuilding it.
+    Only new or changed documents are read and embedded (in batches of
+    `batch_size`) and appended as new rows. Rows of changed or removed
+    documents are marked deleted in the manifest. Returns a dict with the
+    number of added, updated, deleted and unchanged documents.
+
+    `encoder` is a SentenceTransformer (for "truncate" stores) or a
+    ChunkedEncoder using the store's pooling strategy.
+    """
+    manifest = load_manifest(directory)
+    rows = manifest["rows"]
+    pooling = manifest.get("pooling", "truncate")
+    if pooling != "truncate" and getattr(encoder, "pooling", None) != pooling:
+        raise ValueError(f"Store uses '{pooling}' pooling; pass a ChunkedEncoder with the same pooling")
+    live = {row["doc_id"]: index for index, row in enumerate(rows) if not row["deleted"]}
+    # Quantized copies built for the current rows are kept in step; stale ones are left to be rebuilt.
+    digest = manifest_hash(manifest)
+    quantized_kinds = [kind for kind in QUANTIZATION_KINDS
+                       if os.path.exists(os.path.join(directory, f"embeddings.{kind}.npy"))
+                       and quantized_manifest_hash(directory, kind) == digest]
+
+    pending = []
+    report = {"added": 0, "updated": 0, "deleted": 0, "unchanged": 0}
+    seen = set()
+    for file in sorted(glob.glob(os.path.join(dataset_path, "*.txt"))):
+        doc_id = doc_id_for(file)
+        seen.add(doc_id)
+        with open(file, "r") as f:
+            digest = content_hash(f.read())
+        if doc_id in live and rows[live[doc_id]]["content_hash"] == digest:
+            report["unchanged"] += 1
+            continue
+        report["updated" if doc_id in live else "added"] += 1
+        if doc_id in live:
+            rows[live[doc_id]]["deleted"] = True
+        pending.append((doc_id, file, digest))
+    for doc_id, index in live.items():
+        if doc_id not in seen:
+            rows[index]["deleted"] = True
+            report["deleted"] += 1
+
+    offsets = np.load(os.path.join(directory, "offsets.npy"), mmap_mode="r")
+    end = int(offsets[len(rows)])
+    del offsets
+    for start in range(0, len(pending), batch_size):
+        batch = pending[start:start + batch_size]
+        texts = []
+        for _, file, _ in batch:
+            with open(file, "r") as f:
+                texts.append(f.read())
+        length = len(rows)
+        if pooling == "maxsim":
+            windows = encoder.encode_windows(texts, batch_size=batch_size)
+            vectors = np.stack([pool(window_vectors, pooling) for window_vectors in windows])
+            passage_offsets = np.load(os.path.join(directory, "passage_offsets.npy"), mmap_mode="r")
+            passage_end = int(passage_offsets[length])
+            del passage_offsets
+            _append_rows(os.path.join(directory, "passages.npy"), np.vstack(windows), passage_end)
+            _append_rows(os.path.join(directory, "passage_offsets.npy"),
+                         passage_end + np.cumsum([len(window_vectors) for window_vectors in windows]), length + 1)
+        else:
+            vectors = encoder.encode(texts, batch_size=batch_size, convert_to_numpy=True,
+                                     normalize_embeddings=True)
+        vectors = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        _append_rows(os.path.join(directory, "embeddings.npy"), vectors, length)
+        for kind in quantized_kinds:
+            quantized = QuantizedVectors.from_matrix(kind, vectors)
+            _append_rows(os.path.join(directory, f"embeddings.{kind}.npy"), quantized.codes, length)
+            if quantized.scales is not None:
+                _append_rows(os.path.join(directory, f"embeddings.{kind}.scales.npy"), quantized.scales, length)
+        new_offsets = []
+        with open(os.path.join(directory, "corpus.txt"), "r+b") as f:
+            f.seek(end)
+            for text in texts:
+                data = text.encode("utf-8")
+                f.write(data)
+                end += len(data)
+                new_offsets.append(end)
+            f.truncate()
+        _append_rows(os.path.join(directory, "offsets.npy"), new_offsets, length + 1)
+        rows.extend({"doc_id": doc_id, "filename": os.path.basename(file), "content_hash": digest,
+                     "deleted": False} for doc_id, file, digest in batch)
+        # The manifest is written last, so an interrupted batch is simply ignored.
+        save_manifest(directory, manifest)
+        for kind in quantized_kinds:
+            _save_quantized_meta(directory, kind, manifest)
+    save_manifest(directory, manifest)
+    return report
+
+
+def convert_legacy_embeddings(dataset_path="data", embeddings_path="document_embeddings_text+entity.pt",
+                              directory=STORE_DIRECTORY):
+    """
+    Builds the memory-mapped store from the dataset folder and the torch
+    embeddings file that compute_similarity used to load on every request.
+    Rows follow sorted(glob("data/*.txt")), as they did there.
+    """
+    import torch
+    loaded_obj = torch.load(embeddings_path, map_location="cpu")
+    embeddings = loaded_obj["embeddings"] if isinstance(loaded_obj, dict) else loaded_obj
+    embeddings = embeddings.float().cpu().numpy()
+    doc_files = sorted(glob.glob(os.path.join(dataset_path, "*.txt")))
+    if len(doc_files) != len(embeddings):
+        raise ValueError(f"{len(doc_files)} documents but {len(embeddings)} embeddings")
+    texts = []
+    for file in doc_files:
+        with open(file, "r") as f:
+            texts.append(f.read())
+    write_store(directory, [os.path.basename(file) for file in doc_files], texts, embeddings)
+    return len(doc_files)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build or update the memory-mapped similarity store.")
+    parser.add_argument("command", nargs="?", choices=["convert", "build", "update"], default="convert",
+                        help="convert: build from the legacy .pt embeddings; "
+                             "build: create a new store with --pooling and embed the dataset; "
+                             "update: embed only new or changed documents and mark removed ones deleted")
+    parser.add_argument("--data", default="data")
+    parser.add_argument("--embeddings", default="document_embeddings_text+entity.pt")
+    parser.add_argument("--out", default=STORE_DIRECTORY)
+    parser.add_argument("--model", default="fine_tuned_similarity_model_ver2.0")
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--pooling", choices=POOLING_STRATEGIES, default="mean",
+                        help="how long documents are encoded (build only)")
+    args = parser.parse_args()
+    if args.command == "convert":
+        count = convert_legacy_embeddings(args.data, args.embeddings, args.out)
+        print(f"Wrote {count} documents to {args.out}")
+    else:
+        from sentence_transformers import SentenceTransformer
+        model = SentenceTransformer(args.model)
+        if args.command == "build":
+            create_empty_store(args.out, model.get_sentence_embedding_dimension(), args.pooling)
+        encoder = ChunkedEncoder(model, pooling=load_manifest(args.out).get("pooling", "truncate"))
+        report = update_store(encoder, args.data, args.out, args.batch_size)
+        print(f"Updated {args.out}: {report}")
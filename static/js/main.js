@@ -17,6 +17,12 @@ document.addEventListener('DOMContentLoaded', function() {
       loading.style.display = 'block';
       
       try {
+        // Questions are streamed so the answer renders as it is generated.
+        if (formData.get('action') === 'qa_query') {
+          await streamAnswer(formData, resultBox, loading);
+          return;
+        }
+
         const response = await fetch('/process', {
           method: 'POST',
           body: formData
@@ -52,3 +58,57 @@ function displayResults(result, resultBox) {
     resultBox.textContent = result;
   }
 }
+
+async function streamAnswer(formData, resultBox, loading) {
+  const response = await fetch('/process/stream', {
+    method: 'POST',
+    body: formData
+  });
+  if (!response.ok || !response.body) {
+    const data = await response.json().catch(() => ({}));
+    throw new Error(data.error || 'An error occurred during processing');
+  }
+
+  const sources = document.createElement('details');
+  const answer = document.createElement('div');
+  answer.style.whiteSpace = 'pre-wrap';
+  resultBox.appendChild(answer);
+
+  const reader = response.body.getReader();
+  const decoder = new TextDecoder();
+  let buffer = '';
+  while (true) {
+    const { value, done } = await reader.read();
+    if (done) break;
+    buffer += decoder.decode(value, { stream: true });
+    // Server-sent events are separated by a blank line.
+    let boundary;
+    while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+      const raw = buffer.slice(0, boundary);
+      buffer = buffer.slice(boundary + 2);
+      let event = 'message';
+      let data = '';
+      raw.split('\n').forEach(line => {
+        if (line.startsWith('event: ')) event = line.slice(7);
+        else if (line.startsWith('data: ')) data += line.slice(6);
+      });
+      const payload = data ? JSON.parse(data) : null;
+      if (event === 'sources') {
+        const summary = document.createElement('summary');
+        summary.textContent = `Retrieved sources (${payload.length})`;
+        sources.appendChild(summary);
+        payload.forEach(text => {
+          const p = document.createElement('p');
+          p.textContent = text;
+          sources.appendChild(p);
+        });
+        resultBox.insertBefore(sources, answer);
+      } else if (event === 'token') {
+        loading.style.display = 'none';
+        answer.textContent += payload;
+      } else if (event === 'error') {
+        throw new Error(payload);
+      }
+    }
+  }
+}
@@ -1,8 +1,18 @@
+import os
 import re
+import json
+import time
+import bisect
+import logging
+import itertools
+import argparse
 import torch
 from transformers import LEDTokenizer, LEDForConditionalGeneration
 import spacy
 from spacy import displacy
+from model_registry import model_revision, registry
+from summary_cache import SummaryCache, summary_key
+from legal_segmenter import Span, segment_sentences
 
 def load_ner_model():
     # Adjust the model path as needed.
@@ -21,6 +31,28 @@ def load_summarization_model():
     tokenizer.pad_token = tokenizer.eos_token
     return tokenizer, model
 
+# Sentences come from legal_segmenter, so the NER pipeline needs no sentencizer.
+registry.register("ner", load_ner_model)
+registry.register("summarization", load_summarization_model)
+registry.register("spacy_en", lambda: spacy.load("en_core_web_sm"))
+
+EXTRACTIVE_SENTENCES = 50
+ABSTRACTIVE_MAX_INPUT = 9000
+HYBRID_MAX_INPUT = 2048
+GENERATION_PARAMS = {"max_length": 1024, "min_length": 100, "no_repeat_ngram_size": 3, "early_stopping": True}
+CHUNK_SUMMARY_TOKENS = 256
+SUMMARY_METHODS = ("Extractive", "Abstractive", "Abstractive-Chunked", "Extractive-Abstractive")
+REDUCE_MAX_INPUT = 4096
+
+# Map-reduce ("Abstractive-Chunked") summaries: tokens per chunk, input tokens summarized
+# per request, seconds per request and chunks per generate() call.
+SUMMARY_CHUNK_TOKENS = int(os.environ.get("CASESAGE_SUMMARY_CHUNK_TOKENS", 2048))
+SUMMARY_TOKEN_BUDGET = int(os.environ.get("CASESAGE_SUMMARY_TOKEN_BUDGET", 16384))
+SUMMARY_TIME_LIMIT = float(os.environ.get("CASESAGE_SUMMARY_TIME_LIMIT", 300))
+SUMMARY_MAP_BATCH_SIZE = int(os.environ.get("CASESAGE_SUMMARY_MAP_BATCH_SIZE", 4))
+# Share of the time limit role labelling may take before chunking falls back to sentences.
+SECTION_TIME_FRACTION = 0.25
+
 def clean_summary(summary):
     # Ensure summary ends with a full stop.
     if not summary.endswith('.'):
@@ -30,71 +62,326 @@ def clean_summary(summary):
 def extractive_summary(text, ner_model):
     doc = ner_model(text)
     from collections import defaultdict
+    # Score the legal segmenter's sentences by the entities that start in them.
+    spans = list(segment_sentences(text))
+    starts = [span.start for span in spans]
     sentence_scores = defaultdict(float)
-    for sent in doc.sents:
-        for ent in sent.ents:
-            sentence_scores[sent] += 1
-    num_sentences = 50  # adjust as needed
+    for ent in doc.ents:
+        index = bisect.bisect_right(starts, ent.start_char) - 1
+        if index >= 0 and ent.start_char < spans[index].end:
+            sentence_scores[spans[index]] += 1
+    num_sentences = EXTRACTIVE_SENTENCES
     top_sentences = sorted(sentence_scores.keys(), key=lambda x: sentence_scores[x], reverse=True)[:num_sentences]
-    summary = " ".join(str(sent) for sent in top_sentences)
+    summary = " ".join(span.text(text) for span in top_sentences)
     return clean_summary(summary)
 
 def abstractive_summary(text, tokenizer, model):
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-    inputs = tokenizer(text, return_tensors="pt", truncation=True, max_length=9000).to(device)
-    summary_ids = model.generate(
-        **inputs,
-        max_length=1024,
-        min_length=100,
-        no_repeat_ngram_size=3,
-        early_stopping=True
-    )
+    inputs = tokenizer(text, return_tensors="pt", truncation=True, max_length=ABSTRACTIVE_MAX_INPUT).to(device)
+    summary_ids = model.generate(**inputs, **GENERATION_PARAMS)
     summary_final = tokenizer.decode(summary_ids[0], skip_special_tokens=True)
     return clean_summary(summary_final)
 
 def abstractive_summary_hybrid(text, tokenizer, model):
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-    inputs = tokenizer(text, return_tensors="pt", truncation=True, max_length=2048).to(device)
-    summary_ids = model.generate(
-        **inputs,
-        max_length=1024,
-        min_length=100,
-        no_repeat_ngram_size=3,
-        early_stopping=True
-    )
+    inputs = tokenizer(text, return_tensors="pt", truncation=True, max_length=HYBRID_MAX_INPUT).to(device)
+    summary_ids = model.generate(**inputs, **GENERATION_PARAMS)
     summary_final = tokenizer.decode(summary_ids[0], skip_special_tokens=True)
     return clean_summary(summary_final)
 
+def split_sections(text, use_roles=True, deadline=None, report=None):
+    """
+    Returns Spans of the judgment's rhetorical sections: runs of consecutive
+    sentences that semantic_module gives the same role. Falls back to the
+    segmenter's sentences when the role classifier is unavailable, or when
+    labelling is still running at `deadline` (a time.perf_counter() value);
+    the latter sets report["timed_out"] when `report` is a dict.
+    """
+    if use_roles:
+        try:
+            # Importing semantic_module registers the role classifier.
+            from semantic_module import classifier_version
+            model, tokenizer = registry.get("role_classifier")
+        except (ImportError, OSError) as e:
+            # Missing packages, or no ./saved_model/ or ./saved_tokenizer/.
+            logging.warning(f"Role classifier unavailable, chunking on sentences: {e}")
+        else:
+            sections = _role_sections(text, model, tokenizer, classifier_version(model), deadline)
+            if sections is None and report is not None:
+                report["timed_out"] = True
+            if sections:
+                return sections
+    return list(segment_sentences(text))
+
+def _role_sections(text, model, tokenizer, version, deadline):
+    from semantic_module import CLASSIFIER_CHUNK_SENTENCES, iter_features, label_features
+    sections = []
+    features = iter_features(text)
+    while True:
+        chunk = list(itertools.islice(features, CLASSIFIER_CHUNK_SENTENCES))
+        if not chunk:
+            return [span for span, _ in sections]
+        if deadline is not None and sections and time.perf_counter() > deadline:
+            logging.warning("Role labelling ran out of time, chunking on sentences")
+            return None
+        labels, _ = label_features(chunk, model, tokenizer, version)
+        for (start, end, _, _), label in zip(chunk, labels):
+            if sections and sections[-1][1] == label:
+                sections[-1][0] = Span(sections[-1][0].start, end)
+            else:
+                sections.append([Span(start, end), label])
+
+def _token_lengths(tokenizer, texts):
+    if not texts:
+        return []
+    return [len(ids) for ids in tokenizer(texts, add_special_tokens=False)["input_ids"]]
+
+def pack_chunks(text, sections, tokenizer, chunk_tokens):
+    """
+    Packs consecutive sections into chunks of at most `chunk_tokens` tokens,
+    splitting a longer section on its sentences and a longer sentence
+    between its words. Returns (Span, tokens) pairs; a chunk covers
+    everything between its first and last section.
+    """
+    pieces = []
+    for span, tokens in zip(sections, _token_lengths(tokenizer, [span.text(text) for span in sections])):
+        if tokens <= chunk_tokens:
+            pieces.append((span, tokens))
+            continue
+        sentences = [Span(span.start + sentence.start, span.start + sentence.end)
+                     for sentence in segment_sentences(span.text(text))]
+        for sentence, tokens in zip(sentences, _token_lengths(tokenizer, [sentence.text(text) for sentence in sentences])):
+            if tokens <= chunk_tokens:
+                pieces.append((sentence, tokens))
+                continue
+            # A run-on sentence (a long list, a table flattened to text) is cut between words.
+            words = [Span(sentence.start + match.start(), sentence.start + match.end())
+                     for match in re.finditer(r"\s*\S+", sentence.text(text))]
+            pieces.extend(zip(words, _token_lengths(tokenizer, [word.text(text) for word in words])))
+    chunks = []
+    start = end = None
+    total = 0
+    for span, tokens in pieces:
+        # A single word longer than a chunk is truncated to chunk_tokens by generate_batch().
+        tokens = min(tokens, chunk_tokens)
+        if start is not None and total + tokens > chunk_tokens:
+            chunks.append((Span(start, end), total))
+            start, total = None, 0
+        if start is None:
+            start = span.start
+        end = span.end
+        total += tokens
+    if start is not None:
+        chunks.append((Span(start, end), total))
+    return chunks
+
+def _priority(count):
+    # The operative part of a judgment is at the end and the parties and facts at the
+    # start, so chunks are taken from both ends inwards: last, first, second last, ...
+    order = []
+    low, high = 0, count - 1
+    while low <= high:
+        order.append(high)
+        high -= 1
+        if low <= high:
+            order.append(low)
+            low += 1
+    return order
+
+def generate_batch(texts, tokenizer, model, max_input_tokens, max_length, min_length):
+    # One padded generate() call for several inputs.
+    device = next(model.parameters()).device
+    inputs = tokenizer(texts, return_tensors="pt", padding=True, truncation=True,
+                       max_length=max_input_tokens).to(device)
+    with torch.inference_mode():
+        summary_ids = model.generate(**inputs, **dict(GENERATION_PARAMS, max_length=max_length, min_length=min_length))
+    return tokenizer.batch_decode(summary_ids, skip_special_tokens=True)
+
+def map_reduce_summary(text, tokenizer, model, chunk_tokens=SUMMARY_CHUNK_TOKENS, token_budget=SUMMARY_TOKEN_BUDGET,
+                       time_limit=SUMMARY_TIME_LIMIT, batch_size=SUMMARY_MAP_BATCH_SIZE,
+                       chunk_summary_tokens=CHUNK_SUMMARY_TOKENS, reduce_tokens=REDUCE_MAX_INPUT, use_roles=True,
+                       report=None):
+    """
+    Summarizes a long judgment without truncating it: the judgment is split
+    into chunks on its rhetorical sections, the chunks are summarized in
+    padded batches (map) and the chunk summaries are summarized together in
+    a final pass (reduce).
+
+    At most `token_budget` input tokens are summarized in the map pass and
+    no new batch is started once it would overrun `time_limit` seconds;
+    chunks are taken from both ends of the judgment inwards, so the
+    operative part is kept when either limit cuts the map pass short. If
+    there is no time left for the reduce pass, the chunk summaries are
+    joined instead. Role labelling gets at most SECTION_TIME_FRACTION of
+    `time_limit`, after which the chunks are packed from sentences. When
+    `report` is a dict it is filled with chunk counts, token counts and
+    timings.
+    """
+    started = time.perf_counter()
+    section_report = {}
+    sections = split_sections(text, use_roles, deadline=started + SECTION_TIME_FRACTION * time_limit,
+                              report=section_report) if text.strip() else []
+    section_seconds = time.perf_counter() - started
+    chunks = pack_chunks(text, sections, tokenizer, chunk_tokens)
+    if not chunks:
+        # Nothing to summarize (an empty or whitespace-only judgment).
+        if report is not None:
+            report.update({"chunks": 0, "summarized_chunks": 0, "section_seconds": section_seconds,
+                           "document_tokens": 0, "summarized_tokens": 0, "reduced": False,
+                           "timed_out": section_report.get("timed_out", False), "map_seconds": 0.0,
+                           "reduce_seconds": 0.0, "seconds": time.perf_counter() - started})
+        return ""
+    selected, used = [], 0
+    for index in _priority(len(chunks)):
+        if used + chunks[index][1] <= token_budget:
+            selected.append(index)
+            used += chunks[index][1]
+
+    summaries = {}
+    batch_seconds = 0.0
+    # Sections cut short by the time limit count too: the summary is not cached.
+    timed_out = section_report.get("timed_out", False)
+    map_started = time.perf_counter()
+    for start in range(0, len(selected), batch_size):
+        if summaries and time.perf_counter() + batch_seconds - started > time_limit:
+            timed_out = True
+            break
+        batch = selected[start:start + batch_size]
+        batch_started = time.perf_counter()
+        outputs = generate_batch([chunks[index][0].text(text) for index in batch], tokenizer, model,
+                                 chunk_tokens, chunk_summary_tokens, min(32, chunk_summary_tokens))
+        summaries.update(zip(batch, outputs))
+        batch_seconds = time.perf_counter() - batch_started
+    map_seconds = time.perf_counter() - map_started
+
+    ordered = [summaries[index].strip() for index in sorted(summaries)]
+    reduce_started = time.perf_counter()
+    reduced = False
+    if len(ordered) == 1:
+        summary = ordered[0]
+    elif time.perf_counter() + batch_seconds - started > time_limit:
+        summary = " ".join(ordered)
+        timed_out = True
+    else:
+        summary = generate_batch([" ".join(ordered)], tokenizer, model, reduce_tokens,
+                                 GENERATION_PARAMS["max_length"], GENERATION_PARAMS["min_length"])[0]
+        reduced = True
+    if report is not None:
+        report.update({"chunks": len(chunks), "summarized_chunks": len(summaries), "section_seconds": section_seconds,
+                       "document_tokens": sum(tokens for _, tokens in chunks),
+                       "summarized_tokens": sum(chunks[index][1] for index in summaries),
+                       "reduced": reduced, "timed_out": timed_out, "map_seconds": map_seconds,
+                       "reduce_seconds": time.perf_counter() - reduce_started,
+                       "seconds": time.perf_counter() - started})
+    return clean_summary(summary)
+
 def combined_summary(text, ner_model, tokenizer, model):
     extractive_sum = extractive_summary(text, ner_model)
     return abstractive_summary_hybrid(extractive_sum, tokenizer, model)
 
+def generation_params(method):
+    """
+    The settings that determine the output of a summarization method.
+    """
+    if method == "Extractive":
+        return {"sentences": EXTRACTIVE_SENTENCES}
+    if method == "Abstractive":
+        return dict(GENERATION_PARAMS, max_input=ABSTRACTIVE_MAX_INPUT)
+    if method == "Extractive-Abstractive":
+        return dict(GENERATION_PARAMS, max_input=HYBRID_MAX_INPUT, sentences=EXTRACTIVE_SENTENCES)
+    return dict(GENERATION_PARAMS, chunk_tokens=SUMMARY_CHUNK_TOKENS, token_budget=SUMMARY_TOKEN_BUDGET,
+                chunk_summary_tokens=CHUNK_SUMMARY_TOKENS, reduce_max_input=REDUCE_MAX_INPUT,
+                role_backend=os.environ.get("CASESAGE_CLASSIFIER_BACKEND", "torch"))
+
+def summary_cache_key(text, method):
+    paths = {"Extractive": ["model-best-3"], "Abstractive": ["legal_abs_model"],
+             "Extractive-Abstractive": ["model-best-3", "legal_abs_model"],
+             "Abstractive-Chunked": ["legal_abs_model"]}[method]
+    if method == "Abstractive-Chunked":
+        # The chunks follow the role classifier's sections, so the key covers the backend actually loaded.
+        try:
+            from semantic_module import role_classifier_path
+        except ImportError:
+            # split_sections() falls back to sentences.
+            pass
+        else:
+            paths.append(role_classifier_path())
+    return summary_key(text, method, generation_params(method), model_revision(*paths))
+
+# Summaries on disk, shared by all workers: CASESAGE_SUMMARY_CACHE_SIZE entries at most
+# (0 disables it) and optionally CASESAGE_SUMMARY_CACHE_MB. Fill it offline with
+# `python summary_cache.py warm DIR`.
+summary_cache = SummaryCache(
+    directory=os.environ.get("CASESAGE_SUMMARY_CACHE_DIR", "summary_cache"),
+    max_entries=int(os.environ.get("CASESAGE_SUMMARY_CACHE_SIZE", 10000)),
+    max_bytes=int(os.environ["CASESAGE_SUMMARY_CACHE_MB"]) * 2**20 if os.environ.get("CASESAGE_SUMMARY_CACHE_MB") else None)
+
 def get_summary(text, method="Abstractive"):
     """
     Returns a summary of the given text based on the chosen method.
+    Summaries are served from summary_cache when the same text was already
+    summarized with the same method, settings and model files.
     """
+    if method not in SUMMARY_METHODS:
+        return "Invalid summarization method specified"
+    key = summary_cache_key(text, method)
+    summary = summary_cache.get(key)
+    if summary is not None:
+        return summary
+    report = {}
     if method == "Extractive":
-        ner_model = load_ner_model()
-        if "sentencizer" not in ner_model.pipe_names:
-            ner_model.add_pipe("sentencizer")
-        return extractive_summary(text, ner_model)
+        ner_model = registry.get("ner")
+        summary = extractive_summary(text, ner_model)
     elif method == "Abstractive":
-        tokenizer, model = load_summarization_model()
-        return abstractive_summary(text, tokenizer, model)
-    elif method == "Extractive-Abstractive":
-        ner_model = load_ner_model()
-        if "sentencizer" not in ner_model.pipe_names:
-            ner_model.add_pipe("sentencizer")
-        tokenizer, model = load_summarization_model()
-        return combined_summary(text, ner_model, tokenizer, model)
+        tokenizer, model = registry.get("summarization")
+        summary = abstractive_summary(text, tokenizer, model)
+    elif method == "Abstractive-Chunked":
+        tokenizer, model = registry.get("summarization")
+        summary = map_reduce_summary(text, tokenizer, model, report=report)
     else:
-        return "Invalid summarization method specified"
+        ner_model = registry.get("ner")
+        tokenizer, model = registry.get("summarization")
+        summary = combined_summary(text, ner_model, tokenizer, model)
+    # A summary cut short by the time limit is not cached.
+    if not report.get("timed_out"):
+        summary_cache.put(key, summary, method)
+    return summary
 
 def visualize_ner(text):
     """
     Uses spaCy's displacy to generate an HTML visualization of named entities.
     """
-    nlp = spacy.load("en_core_web_sm")
+    nlp = registry.get("spacy_en")
     doc = nlp(text)
     html = displacy.render(doc, style="ent", page=True)
     return html
+
+def benchmark(filepath="tmp/1973_T_9.txt"):
+    """
+    Compares the single-pass abstractive summary with the map-reduce one on
+    a judgment: latency, the share of the judgment's tokens each read, and
+    summary length.
+    """
+    with open(filepath, "r", encoding="utf-8") as f:
+        text = f.read()
+    tokenizer, model = registry.get("summarization")
+    document_tokens = _token_lengths(tokenizer, [text])[0]
+    results = {"document_tokens": document_tokens}
+
+    started = time.perf_counter()
+    summary = abstractive_summary(text, tokenizer, model)
+    results["single_pass"] = {"seconds": time.perf_counter() - started,
+                              "coverage": min(document_tokens, 9000) / document_tokens,
+                              "summary_words": len(summary.split())}
+
+    report = {}
+    summary = map_reduce_summary(text, tokenizer, model, report=report)
+    results["map_reduce"] = dict(report, coverage=report["summarized_tokens"] / max(report["document_tokens"], 1),
+                                 summary_words=len(summary.split()))
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare single-pass and map-reduce summarization latency.")
+    parser.add_argument("--file", default="tmp/1973_T_9.txt")
+    args = parser.parse_args()
+    print(json.dumps(benchmark(args.file), indent=2))
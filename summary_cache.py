@@ -0,0 +1,158 @@
+"""
+Persistent cache of judgment summaries, shared by all app processes.
+
+    python summary_cache.py warm path/to/judgments --methods Abstractive,Extractive
+    python summary_cache.py stats
+
+`warm` summarizes every .txt judgment under a directory with the given
+methods, skipping those already cached, so later requests for them are
+answered from the cache.
+"""
+import os
+import json
+import time
+import hashlib
+import threading
+import argparse
+
+
+def summary_key(text, method, params, model_revision):
+    """
+    Cache key of a summary: a hash of the document's content hash, the
+    method, its generation parameters and the model revision.
+    """
+    content_hash = hashlib.sha256(text.encode("utf-8")).hexdigest()
+    payload = json.dumps([content_hash, method, params, model_revision], sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class SummaryCache:
+    """
+    Summaries stored as one JSON file per key under `directory`, so the
+    cache survives restarts and is shared between worker processes.
+
+    Hits bump the file's mtime; when more than `max_entries` files or
+    `max_bytes` bytes are stored the least recently used ones are removed.
+    max_entries=0 disables the cache.
+    """
+
+    def __init__(self, directory="summary_cache", max_entries=10000, max_bytes=None):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries, self._bytes = self._scan()
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.json")
+
+    def _scan(self):
+        if not os.path.isdir(self.directory):
+            return 0, 0
+        entries = total = 0
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".json"):
+                entries += 1
+                total += entry.stat().st_size
+        return entries, total
+
+    def get(self, key):
+        if not self.max_entries:
+            return None
+        path = self._path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                entry = json.load(f)
+            os.utime(path)
+        except (OSError, ValueError):
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return entry["summary"]
+
+    def put(self, key, summary, method=None):
+        if not self.max_entries:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"summary": summary, "method": method, "created": time.time()}, f)
+        size = os.path.getsize(tmp_path)
+        existed = os.path.exists(path)
+        os.replace(tmp_path, path)
+        with self._lock:
+            if not existed:
+                self._entries += 1
+                self._bytes += size
+            if self._entries > self.max_entries or (self.max_bytes and self._bytes > self.max_bytes):
+                self._evict()
+
+    def _evict(self):
+        # Other processes write to the same directory, so re-read it before evicting.
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".json"):
+                stat = entry.stat()
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+        files.sort()
+        entries, total = len(files), sum(size for _, size, _ in files)
+        # Evict down to 90% of the limits so a full cache is not rescanned on every put.
+        max_entries = int(self.max_entries * 0.9)
+        max_bytes = int(self.max_bytes * 0.9) if self.max_bytes else None
+        for _, size, path in files:
+            if entries <= max_entries and (not max_bytes or total <= max_bytes):
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            entries -= 1
+            total -= size
+        self._entries, self._bytes = entries, total
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {"entries": self._entries, "bytes": self._bytes, "hits": self.hits, "misses": self.misses,
+                    "hit_rate": self.hits / lookups if lookups else 0.0}
+
+
+def warm(root, methods):
+    from summarization_module import get_summary, summary_cache, summary_cache_key
+    paths = []
+    for dirpath, _, filenames in os.walk(root):
+        paths.extend(os.path.join(dirpath, filename) for filename in sorted(filenames)
+                     if filename.lower().endswith(".txt"))
+    print(f"{len(paths)} judgment(s), methods: {', '.join(methods)}")
+    done = skipped = 0
+    start = time.perf_counter()
+    for path in paths:
+        with open(path, "r", encoding="utf-8") as f:
+            text = f.read()
+        for method in methods:
+            if summary_cache.get(summary_cache_key(text, method)) is not None:
+                skipped += 1
+                continue
+            get_summary(text, method=method)
+            done += 1
+            print(f"[{time.perf_counter() - start:.0f}s] {method}: {path}")
+    print(f"Summarized {done}, already cached {skipped}, in {time.perf_counter() - start:.1f}s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pre-warm or inspect the summary cache.")
+    parser.add_argument("command", choices=["warm", "stats"])
+    parser.add_argument("root", nargs="?", default="legal_documents", help="directory of .txt judgments (warm)")
+    parser.add_argument("--methods", default="Abstractive",
+                        help="comma-separated: Extractive, Abstractive, Abstractive-Chunked, Extractive-Abstractive")
+    args = parser.parse_args()
+    if args.command == "warm":
+        warm(args.root, [method.strip() for method in args.methods.split(",") if method.strip()])
+    else:
+        from summarization_module import summary_cache
+        print(json.dumps(summary_cache.stats(), indent=2))
@@ -0,0 +1,71 @@
+"""
+Shared fixtures: a local fake of Ollama's embeddings endpoint.
+"""
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+
+class FakeOllama(ThreadingHTTPServer):
+    """
+    Answers POST /api/embeddings like Ollama does, recording the prompts and
+    the largest number of requests served at once. Prompts containing
+    "boom" get an HTTP 500.
+    """
+    daemon_threads = True
+    dimension = 8
+
+    def __init__(self, delay=0.005):
+        super().__init__(("127.0.0.1", 0), FakeOllamaHandler)
+        self.delay = delay
+        self.prompts = []
+        self.active = 0
+        self.max_active = 0
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+
+class FakeOllamaHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        server = self.server
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        with server.lock:
+            server.active += 1
+            server.max_active = max(server.max_active, server.active)
+            server.prompts.append(body["prompt"])
+        try:
+            time.sleep(server.delay)
+            if self.path != "/api/embeddings" or "boom" in body["prompt"]:
+                self._reply(500, {"error": "embedding failed"})
+            else:
+                self._reply(200, {"embedding": [float(len(body["prompt"]))] * server.dimension})
+        finally:
+            with server.lock:
+                server.active -= 1
+
+    def _reply(self, status, payload):
+        data = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    server = FakeOllama()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
@@ -0,0 +1,165 @@
+"""
+EmbeddingPipeline against a local fake of Ollama's embeddings endpoint.
+
+    python -m pytest tests/test_ingestion_pipeline.py
+"""
+import hashlib
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+from ingestion_pipeline import EmbeddingPipeline
+
+OllamaEmbeddings = pytest.importorskip("langchain_community.embeddings").OllamaEmbeddings
+
+class FakeProcessor:
+    """
+    The parts of LegalDocumentProcessor the pipeline uses, with in-memory
+    stores. Every line of a file is a chunk.
+    """
+
+    def __init__(self, server, batch_size=4):
+        self.batch_size = batch_size
+        self.dimension = server.dimension
+        self.embeddings = OllamaEmbeddings(model="nomic-embed-text", base_url=server.url)
+        self.stored = {}
+        self.batch_sizes = []
+        self.planned_batches = 0
+        self.written_batches = 0
+        self.max_outstanding_batches = 0
+        self.manifest = {}
+        self._lock = threading.Lock()
+        self.persist_indexes = lambda: None
+
+    def create_chunks(self, file_path, chunk_size=1000, chunk_overlap=200):
+        with open(file_path, "r", encoding="utf-8") as f:
+            return [SimpleNamespace(page_content=line, metadata={"source": file_path})
+                    for line in f.read().splitlines()]
+
+    @staticmethod
+    def doc_key(file_path):
+        return file_path
+
+    @staticmethod
+    def file_fingerprint(file_path):
+        with open(file_path, "rb") as f:
+            return hashlib.sha256(f.read()).hexdigest()
+
+    def plan_chroma_upsert(self, file_path, chunks):
+        ids = [f"{file_path}:{position}:{chunk.page_content}" for position, chunk in enumerate(chunks)]
+        new = [(id_, chunk) for id_, chunk in zip(ids, chunks) if id_ not in self.stored]
+        with self._lock:
+            # Batches of earlier files still waiting for (or being) embedded.
+            self.max_outstanding_batches = max(self.max_outstanding_batches,
+                                               self.planned_batches - self.written_batches)
+            self.planned_batches += -(-len(new) // self.batch_size)
+        return SimpleNamespace(doc_key=self.doc_key(file_path), fingerprint=self.file_fingerprint(file_path),
+                               ids=ids, new_ids=[id_ for id_, _ in new], new_chunks=[chunk for _, chunk in new],
+                               skipped=len(chunks) - len(new))
+
+    def commit_upsert(self, plan):
+        stale_ids = [id_ for id_ in self.stored if id_.startswith(f"{plan.doc_key}:") and id_ not in plan.ids]
+        for id_ in stale_ids:
+            del self.stored[id_]
+        self.manifest[plan.doc_key] = plan.fingerprint
+        return len(stale_ids)
+
+    def discard_upsert(self, plan):
+        for id_ in plan.new_ids:
+            self.stored.pop(id_, None)
+
+    def write_chroma_batch(self, ids, chunks, vectors):
+        assert len(vectors) == len(chunks) and all(len(vector) == self.dimension for vector in vectors)
+        with self._lock:
+            self.stored.update(zip(ids, vectors))
+            self.batch_sizes.append(len(ids))
+            self.written_batches += 1
+
+
+def _write_files(directory, n_files, n_chunks, poison=None):
+    paths = []
+    for i in range(n_files):
+        path = directory / f"judgment_{i}.txt"
+        lines = [f"judgment {i} chunk {j}" for j in range(n_chunks)]
+        if poison is not None and i == poison:
+            lines[-1] = "boom"
+        path.write_text("\n".join(lines), encoding="utf-8")
+        paths.append(str(path))
+    return paths
+
+
+def test_embeds_in_batches_and_skips_stored_chunks(server, tmp_path):
+    processor = FakeProcessor(server)
+    paths = _write_files(tmp_path, n_files=5, n_chunks=10)
+    pipeline = EmbeddingPipeline(processor, parse_workers=1, embed_concurrency=2, batch_size=4,
+                                 max_pending_batches=2)
+
+    report = pipeline.run(paths)
+
+    assert report["files"] == 5
+    assert report["embedded"] == 50 and report["skipped"] == 0
+    assert len(server.prompts) == 50 and len(processor.stored) == 50
+    # 10 chunks per file in batches of at most 4.
+    assert sorted(processor.batch_sizes) == sorted([4, 4, 2] * 5)
+    assert server.max_active <= 2
+
+    again = EmbeddingPipeline(processor, parse_workers=1, batch_size=4).run(paths)
+    assert again["embedded"] == 0 and again["skipped"] == 50
+    assert len(server.prompts) == 50
+
+
+def test_backpressure_bounds_pending_batches(server, tmp_path):
+    server.delay = 0.02
+    processor = FakeProcessor(server)
+    paths = _write_files(tmp_path, n_files=20, n_chunks=4)
+    pipeline = EmbeddingPipeline(processor, parse_workers=1, embed_concurrency=1, batch_size=4,
+                                 max_pending_batches=2)
+
+    report = pipeline.run(paths)
+
+    assert report["embedded"] == 80
+    # The queue holds 2 batches and the embedder one more; parsing waits for them.
+    assert processor.max_outstanding_batches <= 3
+
+
+def test_embedding_errors_are_raised(server, tmp_path):
+    processor = FakeProcessor(server)
+    paths = _write_files(tmp_path, n_files=3, n_chunks=4, poison=1)
+    pipeline = EmbeddingPipeline(processor, parse_workers=1, embed_concurrency=2, batch_size=4)
+
+    with pytest.raises(ValueError, match="500"):
+        pipeline.run(paths)
+    assert not any(id_.startswith(paths[1]) for id_ in processor.stored)
+
+
+def test_unreadable_files_fail_alone(server, tmp_path):
+    processor = FakeProcessor(server)
+    paths = _write_files(tmp_path, n_files=3, n_chunks=4)
+    with open(paths[1], "wb") as f:
+        f.write(b"\xff\xfe not utf-8 \x81")
+    pipeline = EmbeddingPipeline(processor, parse_workers=1, batch_size=4)
+
+    report = pipeline.run(paths)
+
+    assert report["files"] == 2 and report["failed"] == 1 and report["embedded"] == 8
+    assert list(report["failed_files"]) == [paths[1]]
+    assert report["failed_files"][paths[1]].startswith("UnicodeDecodeError")
+
+
+def test_failed_file_keeps_its_previous_version(server, tmp_path):
+    processor = FakeProcessor(server)
+    paths = _write_files(tmp_path, n_files=2, n_chunks=6)
+    EmbeddingPipeline(processor, parse_workers=1, batch_size=4).run(paths)
+    stored, manifest, written = set(processor.stored), dict(processor.manifest), len(processor.batch_sizes)
+
+    # A new version of the second file whose first batch embeds and whose second gets a 500.
+    with open(paths[1], "w", encoding="utf-8") as f:
+        f.write("\n".join([f"revised chunk {j}" for j in range(7)] + ["boom"]))
+    with pytest.raises(ValueError, match="500"):
+        EmbeddingPipeline(processor, parse_workers=1, embed_concurrency=1, batch_size=4).run(paths)
+
+    assert processor.batch_sizes[written:] == [4]
+    # The old version stays indexed and recorded; the written batch of the new one is rolled back.
+    assert set(processor.stored) == stored
+    assert processor.manifest == manifest
@@ -0,0 +1,97 @@
+"""
+LegalDocumentProcessor ingestion with an in-memory vector store and a local
+fake of Ollama's embeddings endpoint.
+
+    python -m pytest tests/test_legal_processor.py
+"""
+import os
+import shutil
+
+import pytest
+
+legal_processor = pytest.importorskip("legal_processor")
+
+
+class FakeChroma:
+    """
+    The parts of the langchain Chroma wrapper (and its collection) the
+    processor uses, backed by a dict.
+    """
+
+    def __init__(self):
+        self.rows = {}
+        self._collection = self
+
+    def upsert(self, ids, embeddings, metadatas, documents):
+        for id_, vector, metadata, text in zip(ids, embeddings, metadatas, documents):
+            self.rows[id_] = {"embeddings": vector, "metadatas": dict(metadata), "documents": text}
+
+    def update(self, ids, metadatas):
+        for id_, metadata in zip(ids, metadatas):
+            self.rows[id_]["metadatas"] = dict(metadata)
+
+    def get(self, ids=None, where=None, include=()):
+        matches = [id_ for id_, row in self.rows.items()
+                   if (ids is None or id_ in ids)
+                   and all(row["metadatas"].get(key) == value for key, value in (where or {}).items())]
+        result = {"ids": matches}
+        for field in include:
+            result[field] = [self.rows[id_][field] for id_ in matches]
+        return result
+
+    def delete(self, ids):
+        for id_ in ids:
+            self.rows.pop(id_, None)
+
+    def persist(self):
+        pass
+
+
+@pytest.fixture
+def processor(server, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("OLLAMA_BASE_URL", server.url)
+    os.makedirs("tmp")
+    processor = legal_processor.LegalDocumentProcessor(storage_folder="tmp")
+    processor._chroma_db = FakeChroma()
+    return processor
+
+
+def _write_judgment(path, n_paragraphs=3):
+    text = "\n\n".join(f"Paragraph {i}. " + "The appellant contends that the order is bad in law. " * 10
+                       for i in range(n_paragraphs))
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(text)
+
+
+def test_absolute_upload_is_not_reingested_by_setup_retrievers(processor, server):
+    _write_judgment(os.path.join("tmp", "judgment.txt"))
+    report = processor.store_in_chroma([os.path.abspath(os.path.join("tmp", "judgment.txt"))], parse_workers=1)
+    assert report["embedded"] > 0
+    stored = set(processor._chroma_db.rows)
+    prompts = len(server.prompts)
+
+    processor.setup_retrievers()
+
+    assert set(processor._chroma_db.rows) == stored
+    assert len(server.prompts) == prompts
+    assert list(processor.get_bm25_index().files) == [os.path.realpath(os.path.join("tmp", "judgment.txt"))]
+
+
+def test_copies_share_chunks_and_survive_changes_to_the_original(processor, server):
+    original, copy = os.path.join("tmp", "a.txt"), os.path.join("tmp", "b.txt")
+    _write_judgment(original)
+    processor.store_in_chroma([original], parse_workers=1)
+    stored = set(processor._chroma_db.rows)
+    prompts = len(server.prompts)
+
+    shutil.copyfile(original, copy)
+    report = processor.store_in_chroma([copy], parse_workers=1)
+    assert report["embedded"] == 0 and report["skipped"] == len(stored)
+    assert len(server.prompts) == prompts
+
+    # Replacing the original hands its old chunks over to the copy instead of deleting them.
+    _write_judgment(original, n_paragraphs=1)
+    processor.store_in_chroma([original], parse_workers=1)
+    assert stored <= set(processor._chroma_db.rows)
+    assert all(processor._chroma_db.rows[id_]["metadatas"]["doc_key"] == os.path.realpath(copy) for id_ in stored)
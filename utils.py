@@ -2,11 +2,39 @@ import os
 from summarization_module import get_summary  
 from qa_module import qa_upload_file, qa_answer_question
 from flask import request
+from pypdf import PdfReader
+from werkzeug.utils import secure_filename
 
 def allowed_file(filename):
     ALLOWED_EXTENSIONS = {'txt', 'pdf', 'doc', 'docx'}
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+def extract_pdf_text(stream):
+    # Accepts a path or a binary file object.
+    reader = PdfReader(stream)
+    query_text = ""
+    for page in reader.pages:
+        text = page.extract_text()
+        if text:
+            query_text += text + " "
+    return query_text
+
+def read_uploaded_documents(files):
+    """
+    Returns a (filename, text) pair for each uploaded file of a batch
+    request. Raises ValueError naming the first file of an unsupported type.
+    """
+    documents = []
+    for file in files:
+        if not allowed_file(file.filename):
+            raise ValueError(f'Invalid file type: {file.filename}')
+        if file.filename.lower().endswith('.pdf'):
+            text = extract_pdf_text(file.stream)
+        else:
+            text = file.read().decode('utf-8', errors='ignore')
+        documents.append((secure_filename(file.filename), text))
+    return documents
+
 def process_text(filepath, action, question):
     # Read file text if needed (for summarization/semantic). For QA, we pass the file path.
     if action == 'summarization':
@@ -25,10 +53,11 @@ def process_text(filepath, action, question):
         else:
             return summary
     elif action == 'semantic':
-        from semantic_module import infer, generate_html
-        outputs = infer(filepath)
-        html_results = "".join(generate_html(sentence, label) + "<br>" for label, sentence in outputs)
-        return html_results
+        from semantic_module import label_documents, render_html
+        with open(filepath, "r", encoding="utf-8") as f:
+            text = f.read()
+        result = label_documents([(os.path.basename(filepath), text)])
+        return render_html(result["documents"][0])
     elif action == "qa_upload":
         # For QA, upload and index the file.
         # Here we assume the file is already saved in 'filepath'